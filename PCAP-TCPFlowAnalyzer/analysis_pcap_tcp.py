@@ -1,5 +1,13 @@
+import argparse
 import dpkt
+import mmap
 import socket
+import struct
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from functools import partial
+
+from filter_pcap_tcp import compile_filter
 
 
 # Reads pcap file and returns packets with their timestamps
@@ -10,145 +18,579 @@ def read_pcap_file(file_path):
     return packets
 
 
-# Filters out TCP packets from the pcap data
-def filter_tcp_packets(packets):
-    tcp_packets = []
+# Lazily yields packets with their timestamps, one record at a time
+def iter_pcap_file(file_path):
+    with open(file_path, 'rb') as file:
+        for ts, pkt in dpkt.pcap.Reader(file):
+            yield ts, pkt
+
+
+PCAP_HEADER_LEN = 24
+RECORD_HEADER_LEN = 16
+
+
+# Returns the record header layout, snaplen and timestamp fraction units declared by a pcap global header
+def read_pcap_header(buf):
+    magic = bytes(buf[:4])
+    if magic in (b'\xd4\xc3\xb2\xa1', b'\x4d\x3c\xb2\xa1'):
+        endian = '<'
+    elif magic in (b'\xa1\xb2\xc3\xd4', b'\xa1\xb2\x3c\x4d'):
+        endian = '>'
+    else:
+        raise ValueError('invalid tcpdump header')
+    snaplen = struct.unpack_from(endian + 'I', buf, 16)[0] or 0xffffffff
+    frac_units = 10 ** 9 if magic in (b'\x4d\x3c\xb2\xa1', b'\xa1\xb2\x3c\x4d') else 10 ** 6
+    return struct.Struct(endian + 'IIII'), snaplen, frac_units
+
+
+# Yields (ts, memoryview) for the records of a pcap file without copying packet data.
+# Packets are slices of a read-only mmap; when a byte range is given, only records
+# starting inside [start, end) are yielded.
+def iter_pcap_mmap(file_path, start=PCAP_HEADER_LEN, end=None):
+    with open(file_path, 'rb') as file:
+        buf = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(buf)
+    try:
+        record_header, _, frac_units = read_pcap_header(view)
+        unpack_from = record_header.unpack_from
+        size = len(buf)
+        end = size if end is None else min(end, size)
+        offset = start
+        while offset < end and offset + RECORD_HEADER_LEN <= size:
+            sec, frac, incl_len, _ = unpack_from(buf, offset)
+            data_start = offset + RECORD_HEADER_LEN
+            offset = data_start + incl_len
+            if offset > size:
+                break  # Truncated final record
+            yield sec + frac / frac_units, view[data_start:offset]
+    finally:
+        view.release()
+        try:
+            buf.close()
+        except BufferError:
+            pass  # Packet views are still referenced; the map is released along with them
+
+
+# Lazily yields the TCP packets of a packet stream
+def iter_tcp_packets(packets):
     for ts, packet in packets:
-        eth = dpkt.ethernet.Ethernet(packet)
+        eth = dpkt.ethernet.Ethernet(bytes(packet))
         if isinstance(eth.data, dpkt.ip.IP) and isinstance(eth.data.data, dpkt.tcp.TCP):
-            tcp_packets.append((ts, eth))
-    return tcp_packets
+            yield ts, eth
 
 
-# Estimates the cwnd sizes
-def estimate_cwnd(tcp_packets):
-    cwnd = 1460  # Initial cwnd is set to one MSS
-    ssthresh = 65536  # Slow start threshold is set high initially
-    acked_bytes = 0
-    estimated_cwnds = [cwnd]  # Keeps track of estimated cwnd sizes
-    last_ack = 0
-    duplicate_acks = 0
-
-    # Iterates through each TCP packet to adjust cwnd based on ACKs received
-    for _, eth in tcp_packets:
-        ip = eth.data
-        tcp = ip.data
+# Drops the packets that do not match a filter expression (see filter_pcap_tcp.py) before they are decoded
+def filter_raw_packets(packets, expression):
+    if not expression:
+        return packets
+    matches = compile_filter(expression)
+    return ((ts, frame) for ts, frame in packets if matches(frame))
+
+
+# Filters out TCP packets from the pcap data
+def filter_tcp_packets(packets):
+    return list(iter_tcp_packets(packets))
+
+
+# Fixed-offset layout of an untagged Ethernet + option-less IPv4 + TCP header:
+# ethertype, version/IHL, total length, fragment field, protocol, addresses,
+# ports, seq, ack, data offset/flags and window
+FAST_HEADER = struct.Struct('!12xHBxH2xHxB2x4s4sHHIIHH')
+FAST_HEADER_MIN_LEN = 54  # Ethernet (14) + IPv4 (20) + TCP (20)
+
+
+# Extracts the TCP segment fields of a decoded Ethernet frame
+def segment_from_eth(eth):
+    ip = eth.data
+    tcp = ip.data
+    return ip.src, tcp.sport, ip.dst, tcp.dport, tcp.seq, tcp.ack, tcp.flags, tcp.win, len(tcp.data)
+
+
+# Decodes the TCP segment fields of a raw frame, or returns None for non-TCP frames.
+# Common frames are read at fixed offsets; VLAN tags, IP options, fragments and
+# truncated frames fall back to a full dpkt decode.
+def decode_tcp_segment(frame):
+    if len(frame) >= FAST_HEADER_MIN_LEN:
+        (ethertype, version_ihl, ip_len, fragment, protocol, src, dst,
+         sport, dport, seq, ack, off_flags, win) = FAST_HEADER.unpack_from(frame)
+        if ethertype == 0x0800 and version_ihl == 0x45 and fragment & 0x3fff == 0:
+            if protocol != 6:
+                return None
+            tcp_header_len = (off_flags >> 12) << 2
+            if tcp_header_len >= 20 and 20 + tcp_header_len <= ip_len <= len(frame) - 14:
+                return src, sport, dst, dport, seq, ack, off_flags & 0x1ff, win, ip_len - 20 - tcp_header_len
+
+    eth = dpkt.ethernet.Ethernet(bytes(frame))
+    if isinstance(eth.data, dpkt.ip.IP) and isinstance(eth.data.data, dpkt.tcp.TCP):
+        return segment_from_eth(eth)
+    return None
+
+
+# Lazily yields (ts, segment) for the TCP packets of a raw packet stream
+def iter_tcp_segments(packets):
+    for ts, frame in packets:
+        segment = decode_tcp_segment(frame)
+        if segment is not None:
+            yield ts, segment
+
+
+ANALYZER_VERSION = 4  # Bump whenever flow metrics change, to invalidate cached results
+MSS = 1460  # Maximum segment size assumed by the cwnd estimation
+INITIAL_RTO = 1.0  # Retransmission timeout before any RTT sample (RFC 6298)
+MIN_RTO = 0.2  # Lower bound of the computed RTO, as used by Linux
+MAX_RTO = 60.0
+SEQ_MASK = 0xffffffff  # TCP sequence numbers are 32 bits wide and wrap around
+SEQ_HALF = 1 << 31
+MAX_IN_FLIGHT = 65536  # Unacknowledged segments tracked per flow, e.g. when the ACKs were not captured
+CWND_SAMPLES = 3  # Number of cwnd sizes kept for the report
+IDLE_TIMEOUT = 120.0  # Seconds of capture time without packets before a live flow is finalized
+FIN_LINGER = 2.0  # Seconds a flow stays live after its FIN, to absorb the final ACKs and retransmissions
+MAX_LIVE_FLOWS = 100000  # Live flows kept before the least recently active one is evicted
+
+
+# Incrementally tracked state of one TCP flow, updated as each packet arrives
+class FlowState:
+    __slots__ = (
+        'start_time', 'end_time', 'total_bytes', 'syn_seen', 'fin_seen', 'transactions',
+        'last_ack', 'dup_acks', 'triple_dup_acks', 'max_seq_end', 'timeouts',
+        'inflight_ends', 'inflight_sent', 'inflight_clean', 'inflight_head', 'srtt', 'rttvar', 'rto', 'rtt_samples',
+        'cwnd', 'ssthresh', 'acked_bytes', 'cwnd_last_ack', 'cwnd_dup_acks', 'cwnds',
+    )
+
+    def __init__(self, ts):
+        self.start_time = ts
+        self.end_time = ts
+        self.total_bytes = 0
+        self.syn_seen = False
+        self.fin_seen = False
+        self.transactions = []  # (seq, ack, win) of the first two data packets
+
+        # Duplicate ACK and timeout detection
+        self.last_ack = None  # Last ACK number received from the reverse flow
+        self.dup_acks = 0  # Duplicates of last_ack received since it last changed
+        self.triple_dup_acks = 0
+        self.max_seq_end = None  # Highest sequence number sent so far, unwrapped
+        self.timeouts = 0
+
+        # Segments sent but not yet acknowledged by the reverse flow, sorted by unwrapped end sequence number.
+        # inflight_head is the first live entry; retired entries before it are compacted away lazily.
+        self.inflight_ends = []
+        self.inflight_sent = []  # Time each segment was last (re)transmitted
+        self.inflight_clean = []  # False once retransmitted, so it yields no RTT sample (Karn)
+        self.inflight_head = 0
+
+        # RTT estimation (RFC 6298)
+        self.srtt = None
+        self.rttvar = None
+        self.rto = INITIAL_RTO
+        self.rtt_samples = 0
+
+        # cwnd estimation
+        self.cwnd = MSS  # Initial cwnd is set to one MSS
+        self.ssthresh = 65536  # Slow start threshold is set high initially
+        self.acked_bytes = 0
+        self.cwnd_last_ack = 0
+        self.cwnd_dup_acks = 0
+        self.cwnds = [self.cwnd]  # First estimated cwnd sizes
+
+    def update(self, ts, seq, ack, flags, win, payload_len):
+        self.end_time = ts
+        self.total_bytes += payload_len
+        if flags & dpkt.tcp.TH_SYN:
+            self.syn_seen = True
+        if flags & dpkt.tcp.TH_FIN:
+            self.fin_seen = True
+
+        if payload_len > 0:
+            if len(self.transactions) < 2:
+                self.transactions.append((seq, ack, win))
+
+            # A segment ending at or below the highest sequence sent is a retransmission
+            seq_end = self.unwrap(seq) + payload_len
+            if self.max_seq_end is not None and seq_end <= self.max_seq_end:
+                self.retransmit(ts, seq_end)
+            else:
+                self.max_seq_end = seq_end
+                self.inflight_ends.append(seq_end)
+                self.inflight_sent.append(ts)
+                self.inflight_clean.append(True)
+                if len(self.inflight_ends) - self.inflight_head > MAX_IN_FLIGHT:
+                    self.inflight_head += 1
+                    self.compact_inflight()
+
+        self.update_cwnd(flags, ack)
+
+    # Maps a 32-bit sequence number to the unwrapped one closest to the highest sequence sent, so
+    # that comparisons keep working after the sequence space wraps around 2^32
+    def unwrap(self, seq):
+        reference = self.max_seq_end
+        if reference is None:
+            return seq
+        return reference + ((seq - reference + SEQ_HALF) & SEQ_MASK) - SEQ_HALF
+
+    # Counts a retransmission as a timeout when the segment went unacknowledged for a full RTO
+    def retransmit(self, ts, seq_end):
+        i = bisect_left(self.inflight_ends, seq_end, self.inflight_head)
+        if i == len(self.inflight_ends):
+            return  # Already acknowledged, or sent before tracking started
+        if ts - self.inflight_sent[i] >= self.rto:
+            self.timeouts += 1
+            self.rto = min(self.rto * 2, MAX_RTO)  # Backs off like the sender's retransmission timer
+        self.inflight_sent[i] = ts
+        self.inflight_clean[i] = False
+
+    # Handles an ACK from the reverse flow: counts duplicate ACKs, then retires the segments covered
+    # by the cumulative ACK and samples the RTT. As in RFC 5681, a duplicate is a packet without data,
+    # SYN or FIN that repeats the last ACK number; three of them make a triple duplicate ACK.
+    def acknowledge(self, ts, ack, flags=dpkt.tcp.TH_ACK, payload_len=0):
+        if ack != self.last_ack:
+            self.last_ack = ack
+            self.dup_acks = 0
+        elif payload_len == 0 and not flags & (dpkt.tcp.TH_SYN | dpkt.tcp.TH_FIN):
+            self.dup_acks += 1
+            if self.dup_acks == 3:
+                self.triple_dup_acks += 1
 
+        head = self.inflight_head
+        ends = self.inflight_ends
+        if head == len(ends):
+            return
+        ack = self.unwrap(ack)
+        if ends[head] > ack:
+            return
+        acked = bisect_right(ends, ack, head)
+        if self.inflight_clean[acked - 1]:
+            self.sample_rtt(ts - self.inflight_sent[acked - 1])
+        self.inflight_head = acked
+        self.compact_inflight()
+
+    def sample_rtt(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), MAX_RTO)
+        self.rtt_samples += 1
+
+    # Drops retired in-flight entries once they make up most of the index
+    def compact_inflight(self):
+        head = self.inflight_head
+        if head >= 64 and head * 2 >= len(self.inflight_ends):
+            del self.inflight_ends[:head]
+            del self.inflight_sent[:head]
+            del self.inflight_clean[:head]
+            self.inflight_head = 0
+
+    # Adjusts the estimated cwnd based on the ACK carried by a packet
+    def update_cwnd(self, flags, ack):
         # Increases cwnd based on new ACKs received
-        if tcp.flags & dpkt.tcp.TH_ACK and tcp.ack > last_ack:
-            ack_increment = tcp.ack - last_ack
-            last_ack = tcp.ack
-            acked_bytes += ack_increment
+        if flags & dpkt.tcp.TH_ACK and ack > self.cwnd_last_ack:
+            ack_increment = ack - self.cwnd_last_ack
+            self.cwnd_last_ack = ack
+            self.acked_bytes += ack_increment
 
             # Adjusts cwnd size based on current phase (Slow Start or Congestion Avoidance)
-            if cwnd < ssthresh:
-                cwnd += ack_increment
-                estimated_cwnds.append(cwnd)
+            if self.cwnd < self.ssthresh:
+                self.cwnd += ack_increment
+                self.record_cwnd()
             else:
-                while acked_bytes >= cwnd:
-                    acked_bytes -= cwnd
-                    cwnd += 1460  # Increment cwnd by one MSS
-                    estimated_cwnds.append(cwnd)
+                while self.acked_bytes >= self.cwnd:
+                    self.acked_bytes -= self.cwnd
+                    self.cwnd += MSS  # Increment cwnd by one MSS
+                    self.record_cwnd()
 
         # Detects triple duplicate ACKs and reduces cwnd and ssthresh
-        elif tcp.ack == last_ack:
-            duplicate_acks += 1
-            if duplicate_acks == 3:
-                ssthresh = max(cwnd // 2, 2 * 1460)  # Halves the cwnd
-                cwnd = ssthresh
-                estimated_cwnds.append(cwnd)
+        elif ack == self.cwnd_last_ack:
+            self.cwnd_dup_acks += 1
+            if self.cwnd_dup_acks == 3:
+                self.ssthresh = max(self.cwnd // 2, 2 * MSS)  # Halves the cwnd
+                self.cwnd = self.ssthresh
+                self.record_cwnd()
+
+    def record_cwnd(self):
+        if len(self.cwnds) < CWND_SAMPLES:
+            self.cwnds.append(self.cwnd)
+
 
-    return estimated_cwnds[:3]  # Returns the first three cwnd sizes
+# Replays a list of (ts, eth) TCP packets of one or both directions of a connection and returns the
+# FlowState of the direction of the first packet. Duplicate ACKs are only seen with both directions.
+def replay_flow(tcp_packets):
+    flows = aggregate_tcp_segments((ts, segment_from_eth(eth)) for ts, eth in tcp_packets)
+    return next(iter(flows.values()), None)
+
+
+# Estimates the cwnd sizes
+def estimate_cwnd(tcp_packets):
+    flow = replay_flow(tcp_packets)
+    return flow.cwnds if flow else [MSS]  # Returns the first three cwnd sizes
 
 
 # Detects retransmissions within a TCP flow
 def detect_retransmissions(tcp_flow_packets):
-    sent_packets = {}  # Records when each sequence number was sent
-    acks = {}  # Counts occurrences of each ACK number
-    triple_duplicate_acks_detected = 0
-    timeouts_detected = 0
-    SOME_TIMEOUT_THRESHOLD = 1.0  # Example threshold for detecting timeouts
+    flow = replay_flow(tcp_flow_packets)
+    return (flow.triple_dup_acks, flow.timeouts) if flow else (0, 0)
 
-    for ts, eth in tcp_flow_packets:
-        tcp = eth.data.data
 
-        # Tracks when a sequence number is sent for the first time
-        if tcp.seq not in sent_packets:
-            sent_packets[tcp.seq] = ts
+# Groups TCP segments into flows in a single pass over the (possibly lazy) segment stream
+def aggregate_tcp_segments(segments):
+    flows = {}  # Maps each (src, sport, dst, dport) flow to its FlowState
 
-        # Counts ACKs for triple duplicate ACK detection
-        if tcp.flags & dpkt.tcp.TH_ACK:
-            acks[tcp.ack] = acks.get(tcp.ack, 0) + 1
-            if acks[tcp.ack] == 3:
-                triple_duplicate_acks_detected += 1
+    for ts, (src, sport, dst, dport, seq, ack, flags, win, payload_len) in segments:
+        flow_id = (src, sport, dst, dport)
 
-        # Detects timeouts based on the threshold
-        if tcp.seq in sent_packets and ts - sent_packets[tcp.seq] > SOME_TIMEOUT_THRESHOLD:
-            timeouts_detected += 1
-            sent_packets[tcp.seq] = ts  # Updates the timestamp for potential retransmission
+        # Initializes or updates flow information
+        flow = flows.get(flow_id)
+        if flow is None:
+            flow = flows[flow_id] = FlowState(ts)
+        flow.update(ts, seq, ack, flags, win, payload_len)
 
-    return triple_duplicate_acks_detected, timeouts_detected
+        # ACKs acknowledge the data of the reverse direction of the connection
+        if flags & dpkt.tcp.TH_ACK:
+            reverse = flows.get((dst, dport, src, sport))
+            if reverse is not None:
+                reverse.acknowledge(ts, ack, flags, payload_len)
 
+    return flows
 
-# Identify and analyze TCP flows within the pcap data
-def identify_and_analyze_tcp_flows(tcp_packets):
-    flows = {}  # Stores information about each TCP flow
 
-    for ts, eth in tcp_packets:
-        ip = eth.data
-        tcp = ip.data
-        flow_id = (socket.inet_ntoa(ip.src), tcp.sport, socket.inet_ntoa(ip.dst), tcp.dport)
+# Bounded table of live flows that hands every flow to on_complete(flow_id, flow) once it is finished:
+# on RST, FIN_LINGER seconds after its FIN, after idle_timeout seconds without packets, or when it is
+# the least recently active flow and the table is full. Timeouts are measured in capture time.
+class FlowTable:
+    def __init__(self, on_complete, idle_timeout=IDLE_TIMEOUT, max_flows=MAX_LIVE_FLOWS, fin_linger=FIN_LINGER):
+        self.on_complete = on_complete
+        self.idle_timeout = idle_timeout
+        self.max_flows = max_flows
+        self.fin_linger = fin_linger
+        self.flows = OrderedDict()  # flow id -> FlowState, least recently active first
+        self.closing = OrderedDict()  # flow id -> capture time of its FIN, oldest first
+        self.next_expiry_check = float('-inf')
 
-        # Initializes or updates flow information
-        if flow_id not in flows:
-            flows[flow_id] = {
-                'start_time': ts,
-                'end_time': ts,
-                'total_bytes': len(tcp.data),
-                'packets_tcp': [(ts, tcp)],
-                'packets_eth': [(ts, eth)],
-                'sequence_numbers': {tcp.seq},
-                'syn_seen': tcp.flags & dpkt.tcp.TH_SYN != 0,
-                'fin_seen': False,
-            }
+    def update(self, ts, segment):
+        src, sport, dst, dport, seq, ack, flags, win, payload_len = segment
+        flow_id = (src, sport, dst, dport)
+        flow = self.flows.get(flow_id)
+        if flow is None:
+            if len(self.flows) >= self.max_flows:
+                self.complete(next(iter(self.flows)))
+            flow = self.flows[flow_id] = FlowState(ts)
         else:
-            flow = flows[flow_id]
-            flow['end_time'] = ts
-            flow['total_bytes'] += len(tcp.data)
-            flow['packets_tcp'].append((ts, tcp))
-            flow['packets_eth'].append((ts, eth))
-            flow['sequence_numbers'].add(tcp.seq)
-            if tcp.flags & dpkt.tcp.TH_FIN:
-                flow['fin_seen'] = True
-
-    # Analyzes each flow for throughput, transactions, and cwnd size
+            self.flows.move_to_end(flow_id)
+        flow.update(ts, seq, ack, flags, win, payload_len)
+        if flags & dpkt.tcp.TH_ACK:
+            reverse = self.flows.get((dst, dport, src, sport))
+            if reverse is not None:
+                reverse.acknowledge(ts, ack, flags, payload_len)
+
+        if flags & dpkt.tcp.TH_RST:
+            self.complete(flow_id)
+        elif flags & dpkt.tcp.TH_FIN and flow_id not in self.closing:
+            self.closing[flow_id] = ts
+
+        # Expired flows sit at the front of both queues, so checking once per second is enough
+        if ts >= self.next_expiry_check:
+            self.expire(ts)
+            self.next_expiry_check = ts + 1.0
+
+    # Finalizes flows whose FIN linger or idle timeout has passed
+    def expire(self, now):
+        while self.closing:
+            flow_id, fin_time = next(iter(self.closing.items()))
+            if now - fin_time < self.fin_linger:
+                break
+            self.complete(flow_id)
+        while self.flows:
+            flow_id, flow = next(iter(self.flows.items()))
+            if now - flow.end_time < self.idle_timeout:
+                break
+            self.complete(flow_id)
+
+    def complete(self, flow_id):
+        flow = self.flows.pop(flow_id)
+        self.closing.pop(flow_id, None)
+        self.on_complete(flow_id, flow)
+
+    # Finalizes every remaining flow in order of appearance, e.g. at the end of the capture
+    def flush(self):
+        for flow_id in sorted(self.flows, key=lambda live_id: self.flows[live_id].start_time):
+            self.complete(flow_id)
+
+
+# Groups decoded (ts, eth) TCP packets into flows
+def aggregate_tcp_flows(tcp_packets):
+    return aggregate_tcp_segments((ts, segment_from_eth(eth)) for ts, eth in tcp_packets)
+
+
+# Packs a (src, sport, dst, dport) flow id into 12 bytes that sort like the tuple
+def flow_key(flow_id):
+    src, sport, dst, dport = flow_id
+    return src + sport.to_bytes(2, 'big') + dst + dport.to_bytes(2, 'big')
+
+
+# Unpacks a flow_key back into a flow id
+def flow_id_from_key(key):
+    return key[0:4], int.from_bytes(key[4:6], 'big'), key[6:10], int.from_bytes(key[10:12], 'big')
+
+
+# Formats a flow key with dotted-quad addresses
+def format_flow_id(flow_id):
+    src, sport, dst, dport = flow_id
+    return socket.inet_ntoa(src), sport, socket.inet_ntoa(dst), dport
+
+
+# Prints throughput, transactions, retransmissions and cwnd size of a flow that carried data
+def report_tcp_flow(flow_id, flow):
+    if flow.total_bytes > 0:
+        duration = flow.end_time - flow.start_time
+        throughput = flow.total_bytes / duration if duration > 0 else 0
+        print(f"TCP Flow: {format_flow_id(flow_id)}")
+        print(f"\tDuration: {duration:.2f} seconds")
+        print(f"\tTotal TCP Data Bytes: {flow.total_bytes}")
+        print(f"\tThroughput: {throughput:.2f} bytes/sec")
+        if len(flow.transactions) >= 2:
+            (seq1, ack1, win1), (seq2, ack2, win2) = flow.transactions
+            print(f"\tFirst Transaction - Seq: {seq1}, Ack: {ack1}, Win: {win1}")
+            print(f"\tSecond Transaction - Seq: {seq2}, Ack: {ack2}, Win: {win2}")
+        print(f"\tTriple Duplicate ACKs Detected: {flow.triple_dup_acks}")
+        print(f"\tTimeouts Detected: {flow.timeouts}")
+        if flow.rtt_samples:
+            print(f"\tSmoothed RTT: {flow.srtt * 1000:.2f} ms over {flow.rtt_samples} samples")
+        print(f"\tEstimated cwnd Sizes (in bytes, first three significant changes): {flow.cwnds}")
+        print()
+
+
+# Prints the report of each flow
+def report_tcp_flows(flows):
     for flow_id, flow in flows.items():
-        if flow['total_bytes'] > 0:
-            duration = flow['end_time'] - flow['start_time']
-            throughput = flow['total_bytes'] / duration if duration > 0 else 0
-            print(f"TCP Flow: {flow_id}")
-            print(f"\tDuration: {duration:.2f} seconds")
-            print(f"\tTotal TCP Data Bytes: {flow['total_bytes']}")
-            print(f"\tThroughput: {throughput:.2f} bytes/sec")
-            transactions = [pkt for ts, pkt in flow['packets_tcp'] if len(pkt.data) > 0]
-            if len(transactions) >= 2:
-                first_tran = transactions[0]
-                second_tran = transactions[1]
-                print(f"\tFirst Transaction - Seq: {first_tran.seq}, Ack: {first_tran.ack}, Win: {first_tran.win}")
-                print(f"\tSecond Transaction - Seq: {second_tran.seq}, Ack: {second_tran.ack}, Win: {second_tran.win}")
-            triple_dup_acks, timeouts = detect_retransmissions(flow['packets_eth'])
-            print(f"\tTriple Duplicate ACKs Detected: {triple_dup_acks}")
-            print(f"\tTimeouts Detected: {timeouts}")
-            estimated_cwnds = estimate_cwnd(flow['packets_eth'])
-            print(f"\tEstimated cwnd Sizes (in bytes, first three significant changes): {estimated_cwnds}")
-            print()
+        report_tcp_flow(flow_id, flow)
+
+
+# Identify and analyze TCP flows within the pcap data
+def identify_and_analyze_tcp_flows(tcp_packets):
+    report_tcp_flows(aggregate_tcp_flows(tcp_packets))
+
+
+# Reads, filters and aggregates the pcap file in one streaming pass
+def aggregate_pcap_file(file_path, packet_filter=None):
+    return aggregate_tcp_segments(iter_tcp_segments(filter_raw_packets(iter_pcap_mmap(file_path), packet_filter)))
+
+
+def analyze_pcap_file(file_path):
+    report_tcp_flows(aggregate_pcap_file(file_path))
+
+
+# Streams the pcap file through a bounded FlowTable, reporting each flow as soon as it completes
+def stream_pcap_file(file_path, idle_timeout=IDLE_TIMEOUT, max_flows=MAX_LIVE_FLOWS, packet_filter=None):
+    table = FlowTable(report_tcp_flow, idle_timeout, max_flows)
+    for ts, segment in iter_tcp_segments(filter_raw_packets(iter_pcap_mmap(file_path), packet_filter)):
+        table.update(ts, segment)
+    table.flush()
 
 
 def main():
-    pcap_file_path = "assignment2.pcap" # Adjust the path as needed
-    packets = read_pcap_file(pcap_file_path)
-    tcp_packets = filter_tcp_packets(packets)
-    identify_and_analyze_tcp_flows(tcp_packets)
+    parser = argparse.ArgumentParser(description="Analyze the TCP flows of a pcap file")
+    parser.add_argument('pcap_file', nargs='?', default="assignment2.pcap", help="pcap file to analyze")
+    parser.add_argument('--in-memory', action='store_true',
+                        help="load the whole capture before analyzing it instead of streaming it")
+    parser.add_argument('--columnar', action='store_true',
+                        help="decode into a NumPy packet table and compute flow metrics vectorized (needs numpy)")
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="analyze the capture on this many worker processes (0 = one per core)")
+    parser.add_argument('--build-index', action='store_true',
+                        help="write a flow index sidecar (<pcap_file>.flowidx) for fast --flow queries")
+    parser.add_argument('--flow', metavar='SRC:SPORT,DST:DPORT',
+                        help="analyze a single flow by reading only its packets through the flow index")
+    parser.add_argument('--cache', action='store_true',
+                        help="reuse flow metrics cached for an unchanged capture, or cache them after analyzing it")
+    parser.add_argument('--cache-dir', help="result cache directory (implies --cache)")
+    parser.add_argument('--follow', action='store_true',
+                        help="keep reading a pcap that is still being written and report flow progress periodically")
+    parser.add_argument('--interval', type=float, default=5.0,
+                        help="seconds between --follow progress reports (default: 5)")
+    parser.add_argument('--stream-flows', action='store_true',
+                        help="report each flow as soon as it completes and keep only live flows in memory")
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help=f"seconds without packets before a flow is completed (default: {IDLE_TIMEOUT:g})")
+    parser.add_argument('--max-flows', type=int, default=MAX_LIVE_FLOWS,
+                        help=f"live flows kept before the least recently active is completed (default: {MAX_LIVE_FLOWS})")
+    parser.add_argument('--filter', metavar='EXPR',
+                        help="only analyze packets matching EXPR, e.g. 'host 10.0.0.1 and port 80' (see filter_pcap_tcp.py)")
+    parser.add_argument('--timeseries', metavar='DIR',
+                        help="write per-flow throughput and cwnd-per-RTT time series to DIR/throughput.csv and "
+                             "DIR/cwnd.csv (needs numpy)")
+    parser.add_argument('--bin-interval', type=float, default=1.0,
+                        help="seconds per throughput bin of --timeseries (default: 1)")
+    parser.add_argument('--profile', metavar='JSON_FILE',
+                        help="measure time, packets, bytes and allocations of every stage and write them as JSON "
+                             "('-' = stdout); works with the default and --in-memory modes")
+    parser.add_argument('--cprofile', metavar='PSTATS_FILE',
+                        help="with --profile, also write cProfile statistics of the hottest stage")
+    args = parser.parse_args()
+    if args.filter:
+        if args.columnar or args.build_index or args.flow or args.timeseries:
+            parser.error("--filter cannot be combined with --columnar, --timeseries, --build-index or --flow")
+        try:
+            compile_filter(args.filter)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.flow:
+        from index_pcap_tcp import parse_flow_id
+        try:
+            flow_id = parse_flow_id(args.flow)
+        except ValueError as e:
+            parser.error(f"--flow: {e}")
+    if args.bin_interval <= 0:
+        parser.error("--bin-interval must be positive")
+    if args.jobs < 0:
+        parser.error("--jobs must be 0 (one per core) or more")
+    if args.cprofile and not args.profile:
+        parser.error("--cprofile requires --profile")
+    if args.profile and (args.follow or args.stream_flows or args.build_index or args.flow or args.columnar
+                         or args.timeseries or args.jobs != 1 or args.cache or args.cache_dir):
+        parser.error("--profile only works with the default and --in-memory modes")
+
+    if args.profile:
+        from profile_pcap_tcp import profile_pcap_file, write_profile
+        write_profile(profile_pcap_file(args.pcap_file, args.filter, args.in_memory, args.cprofile), args.profile)
+    elif args.follow:
+        from follow_pcap_tcp import follow_pcap
+        follow_pcap(args.pcap_file, args.interval, args.idle_timeout, args.max_flows, args.filter)
+    elif args.stream_flows:
+        stream_pcap_file(args.pcap_file, args.idle_timeout, args.max_flows, args.filter)
+    elif args.build_index or args.flow:
+        import index_pcap_tcp
+        if args.build_index:
+            print(f"Wrote flow index {index_pcap_tcp.build_flow_index(args.pcap_file)}")
+        if args.flow:
+            flow = index_pcap_tcp.query_flow(args.pcap_file, flow_id)
+            if flow is None:
+                print(f"No TCP flow {args.flow} in {args.pcap_file}")
+            else:
+                report_tcp_flows({flow_id: flow})
+    elif args.timeseries:
+        from timeseries_pcap_tcp import export_pcap_timeseries
+        for path in export_pcap_timeseries(args.pcap_file, args.timeseries, args.bin_interval):
+            print(f"Wrote {path}")
+    elif args.columnar:
+        from columnar_pcap_tcp import analyze_pcap_columnar
+        analyze_pcap_columnar(args.pcap_file)
+    elif args.in_memory:
+        packets = filter_raw_packets(read_pcap_file(args.pcap_file), args.filter)
+        tcp_packets = filter_tcp_packets(packets)
+        identify_and_analyze_tcp_flows(tcp_packets)
+    else:
+        aggregate = partial(aggregate_pcap_file, packet_filter=args.filter)
+        if args.jobs != 1:
+            from parallel_pcap_tcp import aggregate_pcap_parallel
+            aggregate = partial(aggregate_pcap_parallel, jobs=args.jobs, packet_filter=args.filter)
+        if args.cache or args.cache_dir:
+            from cache_pcap_tcp import cached_flows
+            flows = cached_flows(args.pcap_file, aggregate, args.cache_dir, args.filter)
+        else:
+            flows = aggregate(args.pcap_file)
+        report_tcp_flows(flows)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,194 @@
+import argparse
+import csv
+import glob
+import heapq
+import json
+import os
+import shutil
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from analysis_pcap_tcp import (IDLE_TIMEOUT, MAX_LIVE_FLOWS, PCAP_HEADER_LEN, FlowTable, compile_filter,
+                               format_flow_id, read_pcap_header)
+from parallel_pcap_tcp import iter_spilled_segments, partition_pcap_range
+
+CSV_FIELDS = ['src', 'sport', 'dst', 'dport', 'start_time', 'end_time', 'duration', 'total_bytes', 'throughput',
+              'seq1', 'ack1', 'win1', 'seq2', 'ack2', 'win2', 'triple_dup_acks', 'timeouts', 'srtt', 'rtt_samples',
+              'cwnds']
+
+
+def is_pcap_file(path):
+    try:
+        with open(path, 'rb') as file:
+            header = file.read(PCAP_HEADER_LEN)
+        read_pcap_header(header)
+    except (OSError, ValueError):
+        return False
+    return len(header) == PCAP_HEADER_LEN
+
+
+# Expands directories and glob patterns into the pcap files they contain. Files in a directory
+# that are not pcaps (e.g. index sidecars) are skipped silently, named ones with a warning.
+def find_pcap_files(inputs):
+    files = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            files += [path for path in sorted(glob.glob(os.path.join(pattern, '*')))
+                      if os.path.isfile(path) and is_pcap_file(path)]
+            continue
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            print(f"warning: no files match {pattern}", file=sys.stderr)
+        for path in matches:
+            if is_pcap_file(path):
+                files.append(path)
+            else:
+                print(f"warning: skipping {path}, not a pcap file", file=sys.stderr)
+    return list(dict.fromkeys(files))  # Drops files named twice
+
+
+# Groups files into runs whose capture times overlap, in time order. Runs are analyzed one after the
+# other and the files of a run are merged by timestamp, so rotated captures need one open file at a time.
+def overlapping_runs(time_ranges):
+    runs = []
+    run_end = None
+    for index, (first_ts, last_ts) in sorted(time_ranges.items(), key=lambda item: item[1]):
+        if run_end is None or first_ts > run_end:
+            runs.append([])
+            run_end = last_ts
+        runs[-1].append(index)
+        run_end = max(run_end, last_ts)
+    return runs
+
+
+# Yields the (ts, segment) of one shard across all files in timestamp order
+def iter_shard_segments(runs_of_paths):
+    for paths in runs_of_paths:
+        if len(paths) == 1:
+            yield from iter_spilled_segments(paths)
+        else:
+            yield from heapq.merge(*(iter_spilled_segments([path]) for path in paths), key=lambda item: item[0])
+
+
+# Phase 2 worker: aggregates one flow shard over all files, so flows that span files are merged. A bounded
+# FlowTable keeps only the live flows, and each flow is written to `part_path` as soon as it completes.
+# Returns the number of flows written.
+def aggregate_batch_shard(runs_of_paths, part_path, output_format, idle_timeout=IDLE_TIMEOUT,
+                          max_flows=MAX_LIVE_FLOWS):
+    written = 0
+    with open(part_path, 'w', newline='') as part:
+        write_record = flow_record_writer(part, output_format)
+
+        def flow_completed(flow_id, flow):
+            nonlocal written
+            if flow.total_bytes > 0:
+                write_record(flow_record(flow_id, flow))
+                written += 1
+
+        table = FlowTable(flow_completed, idle_timeout, max_flows)
+        for ts, segment in iter_shard_segments(runs_of_paths):
+            table.update(ts, segment)
+        table.flush()
+    return written
+
+
+# Writes the report of many pcap files, analyzed as if they were one capture, on `jobs` processes.
+# Phase 1 decodes every file in parallel and partitions its segments by flow; phase 2 merges the
+# partitions of every file by timestamp and aggregates them in parallel, each shard writing its
+# flows as they complete. The shard reports are then copied to `output`. Returns the flows written.
+def aggregate_pcap_batch(file_paths, output, output_format='jsonl', jobs=None, packet_filter=None,
+                         idle_timeout=IDLE_TIMEOUT, max_flows=MAX_LIVE_FLOWS):
+    jobs = jobs or os.cpu_count()
+    with tempfile.TemporaryDirectory(prefix='pcap-batch-') as spill_dir, ProcessPoolExecutor(jobs) as pool:
+        prefixes = [os.path.join(spill_dir, f"file{i}") for i in range(len(file_paths))]
+        time_ranges = pool.map(partition_pcap_range, file_paths, [PCAP_HEADER_LEN] * len(file_paths),
+                               [None] * len(file_paths), [jobs] * len(file_paths), prefixes,
+                               [packet_filter] * len(file_paths))
+        runs = overlapping_runs({i: time_range for i, time_range in enumerate(time_ranges) if time_range})
+
+        shard_runs = [[[f"{prefixes[i]}.{shard}" for i in run] for run in runs] for shard in range(jobs)]
+        part_paths = [os.path.join(spill_dir, f"report{shard}") for shard in range(jobs)]
+        written = sum(pool.map(aggregate_batch_shard, shard_runs, part_paths, [output_format] * jobs,
+                               [idle_timeout] * jobs, [max_flows] * jobs))
+
+        if output_format == 'csv':
+            csv.DictWriter(output, CSV_FIELDS).writeheader()
+        for part_path in part_paths:
+            with open(part_path, newline='') as part:
+                shutil.copyfileobj(part, output)
+    return written
+
+
+# The reported metrics of a flow that carried data as a flat dict
+def flow_record(flow_id, flow):
+    src, sport, dst, dport = format_flow_id(flow_id)
+    duration = flow.end_time - flow.start_time
+    return {
+        'src': src, 'sport': sport, 'dst': dst, 'dport': dport,
+        'start_time': flow.start_time,
+        'end_time': flow.end_time,
+        'duration': duration,
+        'total_bytes': flow.total_bytes,
+        'throughput': flow.total_bytes / duration if duration > 0 else 0,
+        'transactions': [list(transaction) for transaction in flow.transactions],
+        'triple_dup_acks': flow.triple_dup_acks,
+        'timeouts': flow.timeouts,
+        'srtt': flow.srtt if flow.rtt_samples else None,
+        'rtt_samples': flow.rtt_samples,
+        'cwnds': list(flow.cwnds),
+    }
+
+
+# Returns a function that writes one flow record to `output`, as a JSON line or a CSV row
+def flow_record_writer(output, output_format):
+    if output_format == 'jsonl':
+        return lambda record: output.write(json.dumps(record) + '\n')
+
+    writer = csv.DictWriter(output, CSV_FIELDS)
+
+    def write_row(record):
+        transactions = record.pop('transactions') + [[None, None, None]] * 2
+        (record['seq1'], record['ack1'], record['win1']), (record['seq2'], record['ack2'], record['win2']) = \
+            transactions[:2]
+        record['cwnds'] = ' '.join(map(str, record['cwnds']))
+        writer.writerow(record)
+    return write_row
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyze the TCP flows of many pcap files as one capture")
+    parser.add_argument('inputs', nargs='+', help="pcap files, directories or glob patterns, e.g. 'captures/*.pcap*'")
+    parser.add_argument('--jobs', type=int, default=0, help="worker processes (default: one per core)")
+    parser.add_argument('--output', help="report file (default: stdout)")
+    parser.add_argument('--format', choices=['jsonl', 'csv'],
+                        help="report format (default: from the --output extension, else jsonl)")
+    parser.add_argument('--filter', metavar='EXPR', help="only analyze packets matching EXPR (see filter_pcap_tcp.py)")
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help=f"seconds without packets before a flow is completed (default: {IDLE_TIMEOUT:g})")
+    parser.add_argument('--max-flows', type=int, default=MAX_LIVE_FLOWS,
+                        help=f"live flows kept per worker before the least recently active is completed "
+                             f"(default: {MAX_LIVE_FLOWS})")
+    args = parser.parse_args()
+    if args.filter:
+        try:
+            compile_filter(args.filter)
+        except ValueError as e:
+            parser.error(str(e))
+    output_format = args.format or ('csv' if args.output and args.output.endswith('.csv') else 'jsonl')
+
+    file_paths = find_pcap_files(args.inputs)
+    if not file_paths:
+        parser.error("no pcap files found")
+    if args.output:
+        with open(args.output, 'w', newline='') as output:
+            written = aggregate_pcap_batch(file_paths, output, output_format, args.jobs, args.filter,
+                                           args.idle_timeout, args.max_flows)
+        print(f"Wrote {written} flows from {len(file_paths)} files to {args.output}", file=sys.stderr)
+    else:
+        aggregate_pcap_batch(file_paths, sys.stdout, output_format, args.jobs, args.filter, args.idle_timeout,
+                             args.max_flows)
+
+
+if __name__ == "__main__":
+    main()
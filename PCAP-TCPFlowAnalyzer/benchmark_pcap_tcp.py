@@ -0,0 +1,238 @@
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from analysis_pcap_tcp import (aggregate_pcap_file, detect_retransmissions, estimate_cwnd, filter_tcp_packets,
+                               identify_and_analyze_tcp_flows, iter_pcap_mmap, read_pcap_file, segment_from_eth)
+from batch_pcap_tcp import flow_record
+from generate_pcap_tcp import generate_pcap
+from parallel_pcap_tcp import aggregate_pcap_parallel
+
+STAGES = ['read_pcap_file', 'filter_tcp_packets', 'identify_and_analyze_tcp_flows', 'detect_retransmissions',
+          'estimate_cwnd', 'aggregate_pcap_file']
+DEFAULT_SIZES = '10x1000,50x1000,100x2000'  # flows x data segments per flow
+REGRESSION_THRESHOLD = 0.10  # Relative packets/sec drop flagged against a baseline
+DUP_ACK_CHECK_SIZE = (30, 1000)  # flows x data segments of the duplicate ACK check capture
+WRAP_ISN = 0xffffffff - 300000  # Client ISN of the wrap check captures: sequence numbers wrap after 300000 bytes
+
+
+# Current resident set size in KiB (peak so far where /proc is unavailable)
+def current_rss_kib():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except OSError:
+        return peak_rss_kib()
+
+
+def peak_rss_kib():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak  # macOS reports bytes
+
+
+# Groups (ts, eth) TCP packets into one list per connection, both directions together, as the
+# per-flow stages expect them
+def group_tcp_packets(tcp_packets):
+    connections = {}
+    for ts, eth in tcp_packets:
+        src, sport, dst, dport = segment_from_eth(eth)[:4]
+        connections.setdefault(frozenset([(src, sport), (dst, dport)]), []).append((ts, eth))
+    return list(connections.values())
+
+
+# Prepares the input of a stage untimed and returns (callable running the stage, packets it processes)
+def prepare_stage(stage, pcap_path):
+    if stage == 'read_pcap_file':
+        return lambda: read_pcap_file(pcap_path), sum(1 for _ in iter_pcap_mmap(pcap_path))
+    if stage == 'aggregate_pcap_file':
+        return lambda: aggregate_pcap_file(pcap_path), sum(1 for _ in iter_pcap_mmap(pcap_path))
+    if stage == 'filter_tcp_packets':
+        packets = read_pcap_file(pcap_path)
+        return lambda: filter_tcp_packets(packets), len(packets)
+    tcp_packets = filter_tcp_packets(read_pcap_file(pcap_path))  # The raw packets are not kept alive
+    if stage == 'identify_and_analyze_tcp_flows':
+        def run():
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                identify_and_analyze_tcp_flows(tcp_packets)
+        return run, len(tcp_packets)
+    flows = group_tcp_packets(tcp_packets)
+    per_flow = detect_retransmissions if stage == 'detect_retransmissions' else estimate_cwnd
+    return lambda: [per_flow(flow_packets) for flow_packets in flows], len(tcp_packets)
+
+
+# Runs one stage in the current (fresh) process and measures it
+def run_stage(stage, pcap_path):
+    run, packets = prepare_stage(stage, pcap_path)
+    rss_before = current_rss_kib()
+    start = time.perf_counter()
+    result = run()
+    seconds = time.perf_counter() - start
+    peak = peak_rss_kib()
+    del result
+    return {'stage': stage, 'packets': packets, 'seconds': seconds,
+            'packets_per_sec': packets / seconds if seconds > 0 else 0.0,
+            'peak_rss_mib': peak / 1024, 'rss_growth_mib': max(peak - rss_before, 0) / 1024}
+
+
+# Returns a capture of the given size, generating it unless the work directory already has it
+def capture_path(work_dir, flows, packets, args, isn=None):
+    name = f"synthetic-{flows}x{packets}-loss{args.loss}-reorder{args.reorder}-dup{args.dup_acks}" \
+           f"-payload{args.payload_size}-seed{args.seed}{'' if isn is None else f'-isn{isn}'}.pcap"
+    path = os.path.join(work_dir, name)
+    if not os.path.isfile(path):
+        generate_pcap(path + '.tmp', flows, packets, args.loss, args.reorder, args.dup_acks, args.payload_size,
+                      args.seed, isn=isn)
+        os.replace(path + '.tmp', path)
+    return path
+
+
+# Checks that the parallel analyzer reports exactly what the sequential one does on a capture
+def parallel_matches_sequential(pcap_path, jobs):
+    def records(flows):
+        return [flow_record(flow_id, flow) for flow_id, flow in flows.items()]
+    return records(aggregate_pcap_parallel(pcap_path, jobs)) == records(aggregate_pcap_file(pcap_path))
+
+
+# Checks that two captures of the same transfers, one with sequence numbers that wrap around 2^32,
+# get the same retransmission and RTT metrics, from FlowState and (with numpy) the columnar path
+def wrap_matches_plain(plain_path, wrapped_path):
+    def metrics(path):
+        return [(flow.total_bytes, flow.triple_dup_acks, flow.timeouts, flow.srtt, flow.rtt_samples)
+                for flow in aggregate_pcap_file(path).values()]
+    if metrics(wrapped_path) != metrics(plain_path):
+        return False
+    try:
+        from columnar_pcap_tcp import compute_flow_metrics, read_packet_table
+    except ImportError:
+        return True
+
+    def columnar_metrics(path):
+        return [(flow['total_bytes'], flow['triple_dup_acks'], flow['timeouts'])
+                for flow in compute_flow_metrics(read_packet_table(path))]
+    return columnar_metrics(wrapped_path) == columnar_metrics(plain_path)
+
+
+# Checks that every flow reports one triple duplicate ACK per fast retransmit of the generator, on a
+# capture with losses only, from FlowState and (with numpy) the columnar path
+def dup_acks_match_generator(work_dir, args):
+    recoveries = {}
+    path = os.path.join(work_dir, 'dup-ack-check.pcap')
+    generate_pcap(path, *DUP_ACK_CHECK_SIZE, max(args.loss, 0.01), payload_size=args.payload_size, seed=args.seed,
+                  recoveries=recoveries)
+    flows = aggregate_pcap_file(path)
+    if {flow_id: flow.triple_dup_acks for flow_id, flow in flows.items() if flow.triple_dup_acks} != recoveries:
+        return False
+    try:
+        from columnar_pcap_tcp import compute_flow_metrics, read_packet_table
+    except ImportError:
+        return True
+    columnar = [flow['triple_dup_acks'] for flow in compute_flow_metrics(read_packet_table(path))]
+    return columnar == [flow.triple_dup_acks for flow in flows.values()]
+
+
+def parse_sizes(text):
+    sizes = []
+    for size in text.split(','):
+        flows, _, packets = size.strip().partition('x')
+        sizes.append((int(flows), int(packets)))
+    return sizes
+
+
+def format_change(result, baseline):
+    previous = baseline.get((result['size'], result['stage']))
+    if not previous or not previous['packets_per_sec']:
+        return ''
+    change = result['packets_per_sec'] / previous['packets_per_sec'] - 1
+    return f"{change:+.1%}" + ('  REGRESSION' if change < -REGRESSION_THRESHOLD else '')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the stages of the TCP flow analyzer on synthetic pcaps")
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help=f"comma-separated FLOWSxPACKETS capture sizes (default: {DEFAULT_SIZES})")
+    parser.add_argument('--stages', default=','.join(STAGES), help="comma-separated stages to run (default: all)")
+    parser.add_argument('--loss', type=float, default=0.01, help="segment loss probability (default: 0.01)")
+    parser.add_argument('--reorder', type=float, default=0.005, help="reordering probability (default: 0.005)")
+    parser.add_argument('--dup-acks', type=float, default=0.01,
+                        help="spurious duplicate ACK probability (default: 0.01)")
+    parser.add_argument('--payload-size', type=int, default=512, help="bytes of data per segment (default: 512)")
+    parser.add_argument('--seed', type=int, default=0, help="random seed of the captures (default: 0)")
+    parser.add_argument('--work-dir', help="directory where generated captures are kept and reused "
+                                           "(default: a temporary directory)")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="compare packets/sec with the results of a previous --output")
+    parser.add_argument('--check-jobs', type=int, default=4,
+                        help="check that --jobs N reports the same flows as the sequential analyzer "
+                             "on every capture, 0 to skip (default: 4)")
+    parser.add_argument('--check-wrap', action=argparse.BooleanOptionalAction, default=True,
+                        help="check that the metrics of every capture survive sequence numbers wrapping "
+                             "around 2^32 (default: on)")
+    parser.add_argument('--check-dup-acks', action=argparse.BooleanOptionalAction, default=True,
+                        help="check the triple duplicate ACKs of a lossy capture against the fast retransmits "
+                             "the generator made (default: on)")
+    args = parser.parse_args()
+    stages = args.stages.split(',')
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = {(result['size'], result['stage']): result for result in json.load(baseline_file)}
+
+    results = []
+    mismatches = []
+    with contextlib.ExitStack() as stack:
+        work_dir = args.work_dir or stack.enter_context(tempfile.TemporaryDirectory(prefix='pcap-bench-'))
+        os.makedirs(work_dir, exist_ok=True)
+        # Every stage runs in a new process, so its peak RSS is not inflated by earlier stages
+        spawn = multiprocessing.get_context('spawn')
+        if args.check_dup_acks:
+            matches = dup_acks_match_generator(work_dir, args)
+            print(f"Triple duplicate ACKs {'match' if matches else 'DO NOT MATCH'} the generator's fast retransmits\n")
+            if not matches:
+                mismatches.append('duplicate ACKs')
+        for flows, packets in parse_sizes(args.sizes):
+            path = capture_path(work_dir, flows, packets, args)
+            size = f"{flows}x{packets}"
+            print(f"Capture {size}: {flows} flows x {packets} data segments, "
+                  f"{os.path.getsize(path) / 2 ** 20:.1f} MiB")
+            if args.check_jobs:
+                matches = parallel_matches_sequential(path, args.check_jobs)
+                print(f"\t--jobs {args.check_jobs} {'matches' if matches else 'DOES NOT MATCH'} the sequential report")
+                if not matches:
+                    mismatches.append(f"{size} --jobs {args.check_jobs}")
+            if args.check_wrap:
+                matches = wrap_matches_plain(path, capture_path(work_dir, flows, packets, args, WRAP_ISN))
+                print(f"\tWrapping sequence numbers {'match' if matches else 'DO NOT MATCH'} the plain capture")
+                if not matches:
+                    mismatches.append(f"{size} wrapped")
+            print(f"\t{'Stage':<32}{'Packets':>10}{'Seconds':>10}{'Packets/sec':>14}{'Peak RSS':>12}"
+                  f"{'RSS growth':>12}  vs baseline")
+            for stage in stages:
+                with ProcessPoolExecutor(1, mp_context=spawn) as pool:
+                    result = pool.submit(run_stage, stage, path).result()
+                result['size'] = size
+                results.append(result)
+                print(f"\t{stage:<32}{result['packets']:>10}{result['seconds']:>10.3f}"
+                      f"{result['packets_per_sec']:>14,.0f}{result['peak_rss_mib']:>9.1f} MiB"
+                      f"{result['rss_growth_mib']:>9.1f} MiB  {format_change(result, baseline)}")
+            print()
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    if mismatches:
+        sys.exit(f"analysis consistency checks failed on: {', '.join(mismatches)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import hashlib
+import json
+import os
+import struct
+from collections import namedtuple
+
+from analysis_pcap_tcp import (ANALYZER_VERSION, CWND_SAMPLES, INITIAL_RTO, MIN_RTO, MSS, flow_id_from_key,
+                               flow_key)
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'pcap-tcp-analyzer')
+HASH_CHUNK = 1 << 24  # Bytes hashed per read
+
+CACHE_MAGIC = b'PCAPFLOWRES1'
+CACHE_HEADER = struct.Struct('<12sI')  # magic, number of flows
+# flow key, start time, end time, data bytes, triple duplicate ACKs, timeouts, smoothed RTT, RTT samples,
+# transaction count, two (seq, ack, win) transactions, cwnd sample count
+FLOW_RECORD = struct.Struct('<12sddQIIdIBIIHIIHB')
+CWND_SAMPLE = struct.Struct('<Q')
+
+# The reported metrics of a flow, with the attribute names report_tcp_flows reads from a FlowState
+CachedFlow = namedtuple('CachedFlow',
+                        'start_time end_time total_bytes transactions triple_dup_acks timeouts srtt rtt_samples cwnds')
+
+
+# Hashes the content of a file, reusing the previous hash while its size and mtime are unchanged
+def content_hash(file_path, cache_dir):
+    stat = os.stat(file_path)
+    path_id = hashlib.blake2b(os.path.abspath(file_path).encode(), digest_size=16).hexdigest()
+    memo_path = os.path.join(cache_dir, f"stat-{path_id}.json")
+    try:
+        with open(memo_path) as memo_file:
+            memo = json.load(memo_file)
+        if memo['size'] == stat.st_size and memo['mtime_ns'] == stat.st_mtime_ns:
+            return memo['hash']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    digest = hashlib.blake2b(digest_size=20)
+    with open(file_path, 'rb') as file:
+        while chunk := file.read(HASH_CHUNK):
+            digest.update(chunk)
+    memo = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': digest.hexdigest()}
+    write_atomically(memo_path, json.dumps(memo).encode())
+    return memo['hash']
+
+
+# Cache key of a capture: its content plus everything that changes the computed metrics
+def result_key(file_path, cache_dir, packet_filter=None):
+    parameters = f"{content_hash(file_path, cache_dir)}:v{ANALYZER_VERSION}:mss={MSS}" \
+                 f":rto={INITIAL_RTO},{MIN_RTO}:cwnd_samples={CWND_SAMPLES}:filter={packet_filter or ''}"
+    return hashlib.blake2b(parameters.encode(), digest_size=20).hexdigest()
+
+
+def write_atomically(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as file:
+        file.write(data)
+    os.replace(tmp_path, path)
+
+
+# Serializes the reported metrics of every flow into the compact binary cache format
+def dump_flows(flows):
+    chunks = [CACHE_HEADER.pack(CACHE_MAGIC, len(flows))]
+    for flow_id, flow in flows.items():
+        transactions = list(flow.transactions) + [(0, 0, 0)] * (2 - len(flow.transactions))
+        (seq1, ack1, win1), (seq2, ack2, win2) = transactions
+        chunks.append(FLOW_RECORD.pack(flow_key(flow_id), flow.start_time, flow.end_time, flow.total_bytes,
+                                       flow.triple_dup_acks, flow.timeouts, flow.srtt or 0.0, flow.rtt_samples,
+                                       len(flow.transactions),
+                                       seq1, ack1, win1, seq2, ack2, win2, len(flow.cwnds)))
+        chunks.extend(CWND_SAMPLE.pack(cwnd) for cwnd in flow.cwnds)
+    return b''.join(chunks)
+
+
+# Restores {flow_id: CachedFlow} from dump_flows output, preserving flow order
+def load_flows(data):
+    magic, count = CACHE_HEADER.unpack_from(data)
+    if magic != CACHE_MAGIC:
+        raise ValueError("not a flow result cache file")
+    flows = {}
+    offset = CACHE_HEADER.size
+    for _ in range(count):
+        (key, start_time, end_time, total_bytes, triple_dup_acks, timeouts, srtt, rtt_samples, transaction_count,
+         seq1, ack1, win1, seq2, ack2, win2, cwnd_count) = FLOW_RECORD.unpack_from(data, offset)
+        offset += FLOW_RECORD.size
+        cwnds = [CWND_SAMPLE.unpack_from(data, offset + i * CWND_SAMPLE.size)[0] for i in range(cwnd_count)]
+        offset += cwnd_count * CWND_SAMPLE.size
+        transactions = [(seq1, ack1, win1), (seq2, ack2, win2)][:transaction_count]
+        flows[flow_id_from_key(key)] = CachedFlow(start_time, end_time, total_bytes, transactions, triple_dup_acks,
+                                                  timeouts, srtt if rtt_samples else None, rtt_samples, cwnds)
+    return flows
+
+
+# Returns the flows of a capture from the cache, or computes them with `aggregate` and caches them.
+# `aggregate` must apply the given packet filter expression itself.
+def cached_flows(file_path, aggregate, cache_dir=None, packet_filter=None):
+    cache_dir = cache_dir or DEFAULT_CACHE_DIR
+    os.makedirs(cache_dir, exist_ok=True)
+    result_path = os.path.join(cache_dir, f"{result_key(file_path, cache_dir, packet_filter)}.flows")
+    try:
+        with open(result_path, 'rb') as result_file:
+            return load_flows(result_file.read())
+    except (OSError, ValueError, struct.error):
+        pass
+
+    flows = aggregate(file_path)
+    write_atomically(result_path, dump_flows(flows))
+    return flows
@@ -0,0 +1,246 @@
+import socket
+import struct
+from array import array
+
+import numpy as np
+
+from analysis_pcap_tcp import (INITIAL_RTO, PCAP_HEADER_LEN, RECORD_HEADER_LEN, SEQ_HALF, SEQ_MASK, decode_tcp_segment,
+                               read_pcap_header)
+
+# One row per TCP packet, one column per header field
+PACKET_DTYPE = np.dtype([
+    ('ts', 'f8'),
+    ('src', 'u4'),
+    ('dst', 'u4'),
+    ('sport', 'u2'),
+    ('dport', 'u2'),
+    ('seq', 'u4'),
+    ('ack', 'u4'),
+    ('flags', 'u2'),
+    ('win', 'u2'),
+    ('payload_len', 'u4'),
+])
+
+# Big-endian view of the fixed-offset Ethernet + IPv4 + TCP header fields,
+# matching the layout of analysis_pcap_tcp.FAST_HEADER
+HEADER_DTYPE = np.dtype({
+    'names': ['ethertype', 'version_ihl', 'ip_len', 'fragment', 'protocol', 'src', 'dst',
+              'sport', 'dport', 'seq', 'ack', 'off_flags', 'win'],
+    'formats': ['>u2', 'u1', '>u2', '>u2', 'u1', '>u4', '>u4',
+                '>u2', '>u2', '>u4', '>u4', '>u2', '>u2'],
+    'offsets': [12, 14, 16, 20, 23, 26, 30, 34, 36, 38, 42, 46, 48],
+    'itemsize': 50,
+})
+HEADER_LEN = HEADER_DTYPE.itemsize
+CHUNK_PACKETS = 1 << 20  # Packets decoded per vectorized batch
+
+TH_FIN, TH_SYN, TH_ACK = 0x01, 0x02, 0x10
+
+
+# Yields the offsets of the pcap record headers in arrays of up to CHUNK_PACKETS, as the walk fills
+# them. Records are variable-length, so only the walk itself is a Python loop: it reads one length
+# per record into a preallocated buffer and leaves every other field to the vectorized decoder.
+def iter_record_batches(buf, endian):
+    length_field = struct.Struct(endian + 'I')
+    unpack_from = length_field.unpack_from
+    batch = array('q', bytes(8 * CHUNK_PACKETS))
+    count = 0
+    offset = PCAP_HEADER_LEN
+    size = len(buf)
+    while offset + RECORD_HEADER_LEN <= size:
+        next_offset = offset + RECORD_HEADER_LEN + unpack_from(buf, offset + 8)[0]
+        if next_offset > size:
+            break  # Truncated final record
+        batch[count] = offset
+        count += 1
+        if count == CHUNK_PACKETS:
+            yield np.frombuffer(batch, dtype='i8').copy()
+            count = 0
+        offset = next_offset
+    if count:
+        yield np.frombuffer(batch, dtype='i8', count=count).copy()
+
+
+# Copies `width` bytes from every offset into an (n, width) slab through a sliding-window view of the
+# buffer, so no (n, width) index array is built. Windows that would run past the end are moved back.
+def gather_bytes(buf, offsets, width):
+    if len(buf) < width:
+        buf = np.concatenate([buf, np.zeros(width - len(buf), dtype='u1')])
+    windows = np.lib.stride_tricks.sliding_window_view(buf, width)
+    return windows[np.minimum(offsets, len(windows) - 1)]
+
+
+# Decodes one batch of records, given the offsets of their record headers, into rows of PACKET_DTYPE
+def decode_records(buf, header_offsets, record_dtype, frac_units):
+    records = gather_bytes(buf, header_offsets, RECORD_HEADER_LEN).view(record_dtype).ravel()
+    ts = records['sec'] + records['frac'] / frac_units
+    offsets = header_offsets + RECORD_HEADER_LEN
+    lengths = records['incl_len'].astype('i8')
+    headers = gather_bytes(buf, offsets, HEADER_LEN).view(HEADER_DTYPE).ravel()
+
+    tcp_header_len = (headers['off_flags'] >> 12).astype('i8') << 2
+    ip_len = headers['ip_len'].astype('i8')
+    fast = ((lengths >= 54) & (headers['ethertype'] == 0x0800) & (headers['version_ihl'] == 0x45)
+            & (headers['fragment'] & 0x3fff == 0))
+    fast_tcp = (fast & (headers['protocol'] == 6) & (tcp_header_len >= 20)
+                & (20 + tcp_header_len <= ip_len) & (ip_len <= lengths - 14))
+
+    rows = np.empty(int(fast_tcp.sum()), dtype=PACKET_DTYPE)
+    picked = headers[fast_tcp]
+    rows['ts'] = ts[fast_tcp]
+    for field in ('src', 'dst', 'sport', 'dport', 'seq', 'ack', 'win'):
+        rows[field] = picked[field]
+    rows['flags'] = picked['off_flags'] & 0x1ff
+    rows['payload_len'] = ip_len[fast_tcp] - 20 - tcp_header_len[fast_tcp]
+
+    # Frames the fast path cannot read (VLAN tags, IP options, ...) are decoded one by one
+    slow_positions, slow_rows = [], []
+    for i in np.flatnonzero(~fast):
+        segment = decode_tcp_segment(buf[offsets[i]:offsets[i] + lengths[i]].tobytes())
+        if segment is not None:
+            src, sport, dst, dport, seq, ack, flags, win, payload_len = segment
+            slow_positions.append(i)
+            slow_rows.append((ts[i], int.from_bytes(src, 'big'), int.from_bytes(dst, 'big'),
+                              sport, dport, seq, ack, flags, win, payload_len))
+    if not slow_rows:
+        return rows
+
+    # Merges both paths back into capture order
+    positions = np.concatenate([np.flatnonzero(fast_tcp), np.array(slow_positions, dtype='i8')])
+    merged = np.concatenate([rows, np.array(slow_rows, dtype=PACKET_DTYPE)])
+    return merged[np.argsort(positions, kind='stable')]
+
+
+# Reads a pcap file into a structured array with one row per TCP packet
+def read_packet_table(file_path):
+    buf = np.memmap(file_path, dtype='u1', mode='r')
+    record_header, _, frac_units = read_pcap_header(buf)
+    endian = record_header.format[0]
+    record_dtype = np.dtype([(name, endian + 'u4') for name in ('sec', 'frac', 'incl_len', 'orig_len')])
+    chunks = [decode_records(buf, header_offsets, record_dtype, frac_units)
+              for header_offsets in iter_record_batches(buf, endian)]
+    return np.concatenate(chunks) if chunks else np.empty(0, dtype=PACKET_DTYPE)
+
+
+# Groups the packets of a non-empty table by flow 4-tuple; the stable sort keeps capture order inside each flow.
+# Returns the sort order, the sorted packets, the first row of every flow and the flow index of every row.
+def group_packets(table):
+    order = np.lexsort((table['dport'], table['dst'], table['sport'], table['src']))
+    packets = table[order]
+    key_changes = ((packets['src'][1:] != packets['src'][:-1]) | (packets['sport'][1:] != packets['sport'][:-1])
+                   | (packets['dst'][1:] != packets['dst'][:-1]) | (packets['dport'][1:] != packets['dport'][:-1]))
+    starts = np.concatenate([[0], np.flatnonzero(key_changes) + 1])
+    group = np.cumsum(np.concatenate([[False], key_changes]))
+    return order, packets, starts, group
+
+
+def flow_id_of_row(packets, row):
+    return (socket.inet_ntoa(int(packets['src'][row]).to_bytes(4, 'big')), int(packets['sport'][row]),
+            socket.inet_ntoa(int(packets['dst'][row]).to_bytes(4, 'big')), int(packets['dport'][row]))
+
+
+# Index of the reverse direction of every flow, or of an extra slot past the last flow when the
+# reverse direction was not captured
+def reverse_groups(packets, starts):
+    endpoints = list(zip(packets['src'][starts].tolist(), packets['sport'][starts].tolist(),
+                         packets['dst'][starts].tolist(), packets['dport'][starts].tolist()))
+    groups = {flow_id: g for g, flow_id in enumerate(endpoints)}
+    return np.array([groups.get((dst, dport, src, sport), len(starts)) for src, sport, dst, dport in endpoints],
+                    dtype='i8')
+
+
+# Computes per-flow metrics with group-by operations over the packet table
+def compute_flow_metrics(table):
+    if len(table) == 0:
+        return []
+
+    order, packets, starts, group = group_packets(table)
+
+    start_time = np.minimum.reduceat(packets['ts'], starts)
+    end_time = np.maximum.reduceat(packets['ts'], starts)
+    total_bytes = np.add.reduceat(packets['payload_len'].astype('i8'), starts)
+    duration = end_time - start_time
+    throughput = np.divide(total_bytes, duration, out=np.zeros(len(starts)), where=duration > 0)
+
+    # Triple duplicate ACKs, counted like FlowState.acknowledge: within the ACKs a flow sends, a run
+    # starts whenever the ACK number changes, and packets without data, SYN or FIN that repeat it are
+    # duplicates. A run with three duplicates is a triple duplicate ACK for the reverse flow.
+    has_ack = packets['flags'] & TH_ACK != 0
+    acks = packets[has_ack]
+    ack_group = group[has_ack]
+    run_starts = np.ones(len(acks), dtype=bool)
+    run_starts[1:] = (ack_group[1:] != ack_group[:-1]) | (acks['ack'][1:] != acks['ack'][:-1])
+    duplicate = ~run_starts & (acks['payload_len'] == 0) & (acks['flags'] & (TH_SYN | TH_FIN) == 0)
+    run_duplicates = np.bincount(np.cumsum(run_starts) - 1, weights=duplicate) if len(acks) else np.zeros(0)
+    triple_runs = np.bincount(ack_group[run_starts][run_duplicates >= 3], minlength=len(starts) + 1)
+    triple_dup_acks = triple_runs[reverse_groups(packets, starts)]
+
+    # Timeouts: retransmitted data sent at least INITIAL_RTO after the packet that first carried it.
+    # Without ACK pairing there is no RTT estimate, so this is the fixed-RTO view of FlowState's rule.
+    # Sequence numbers are unwrapped from one data packet to the next, like FlowState.unwrap, and every
+    # flow is shifted past the range of the one before, so one running maximum respects flow boundaries.
+    has_data = packets['payload_len'] > 0
+    data = packets[has_data]
+    data_group = group[has_data]
+    first_of_group = np.ones(len(data), dtype=bool)
+    first_of_group[1:] = data_group[1:] != data_group[:-1]
+    data_starts = np.flatnonzero(first_of_group)
+    data_flow = np.cumsum(first_of_group) - 1  # Index of every data packet's flow among the flows with data
+    seq = data['seq'].astype('i8')
+    steps = np.zeros(len(data), dtype='i8')
+    steps[1:] = ((seq[1:] - seq[:-1] + SEQ_HALF) & SEQ_MASK) - SEQ_HALF
+    steps[first_of_group] = 0
+    seq_start = np.cumsum(steps)
+    seq_start -= seq_start[data_starts][data_flow]
+    seq_end = seq_start + data['payload_len']
+    if len(data):
+        lowest = np.minimum.reduceat(seq_start, data_starts)
+        spans = np.maximum.reduceat(seq_end, data_starts) - lowest + 1
+        seq_end += (np.concatenate([[0], np.cumsum(spans)[:-1]]) - lowest)[data_flow]
+    running_max = np.maximum.accumulate(seq_end)
+    prev_max = running_max.copy()
+    prev_max[1:] = running_max[:-1]
+    first_sent = np.searchsorted(running_max, seq_end)  # First packet whose data reached seq_end
+    timed_out = ~first_of_group & (seq_end <= prev_max) & (data['ts'] - data['ts'][first_sent] >= INITIAL_RTO)
+    timeouts = np.bincount(data_group[timed_out], minlength=len(starts))
+
+    # First two data packets of every flow
+    data_rank = np.arange(len(data)) - data_starts[data_flow]
+    transactions = [[] for _ in starts]
+    for i in np.flatnonzero(data_rank < 2):
+        transactions[data_group[i]].append((int(data['seq'][i]), int(data['ack'][i]), int(data['win'][i])))
+
+    flows = []
+    for g in np.argsort(order[starts]):  # Reports flows in order of appearance
+        flows.append({
+            'flow_id': flow_id_of_row(packets, starts[g]),
+            'duration': float(duration[g]),
+            'total_bytes': int(total_bytes[g]),
+            'throughput': float(throughput[g]),
+            'transactions': transactions[g],
+            'triple_dup_acks': int(triple_dup_acks[g]),
+            'timeouts': int(timeouts[g]),
+        })
+    return flows
+
+
+# Prints the vectorized flow metrics in the same layout as report_tcp_flows (without cwnd estimates)
+def report_flow_metrics(flows):
+    for flow in flows:
+        if flow['total_bytes'] > 0:
+            print(f"TCP Flow: {flow['flow_id']}")
+            print(f"\tDuration: {flow['duration']:.2f} seconds")
+            print(f"\tTotal TCP Data Bytes: {flow['total_bytes']}")
+            print(f"\tThroughput: {flow['throughput']:.2f} bytes/sec")
+            if len(flow['transactions']) >= 2:
+                (seq1, ack1, win1), (seq2, ack2, win2) = flow['transactions']
+                print(f"\tFirst Transaction - Seq: {seq1}, Ack: {ack1}, Win: {win1}")
+                print(f"\tSecond Transaction - Seq: {seq2}, Ack: {ack2}, Win: {win2}")
+            print(f"\tTriple Duplicate ACKs Detected: {flow['triple_dup_acks']}")
+            print(f"\tTimeouts Detected: {flow['timeouts']}")
+            print()
+
+
+# Builds the packet table of a pcap file and reports its flows
+def analyze_pcap_columnar(file_path):
+    report_flow_metrics(compute_flow_metrics(read_packet_table(file_path)))
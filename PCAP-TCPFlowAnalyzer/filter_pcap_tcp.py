@@ -0,0 +1,159 @@
+import re
+import socket
+import struct
+
+# Packet filter expressions, evaluated on raw frame bytes before anything is decoded:
+#
+#   expr      := term (("or" | "||") term)*
+#   term      := factor (("and" | "&&") factor)*
+#   factor    := ("not" | "!") factor | "(" expr ")" | primitive
+#   primitive := [src | dst] host ADDRESS | [src | dst] port NUMBER | [src | dst] net ADDRESS/PREFIX
+#              | syn | ack | fin | rst | psh | urg
+#
+# e.g. "host 10.0.0.1 and (port 80 or port 443) and not rst". Only IPv4 TCP frames can match.
+
+TCP_FLAGS = {'fin': 0x01, 'syn': 0x02, 'rst': 0x04, 'psh': 0x08, 'ack': 0x10, 'urg': 0x20}
+TOKEN = re.compile(r'\s*(\(|\)|&&|\|\||!|[^\s()!]+)')
+
+# Header fields a compiled filter is evaluated on, all as integers
+FIELDS = {
+    'host': {'src': 'src', 'dst': 'dst'},
+    'net': {'src': 'src', 'dst': 'dst'},
+    'port': {'src': 'sport', 'dst': 'dport'},
+}
+
+# Fixed-offset layout of an untagged Ethernet + option-less IPv4 + TCP header: ethertype,
+# version/IHL, fragment field, protocol, addresses, ports and TCP flags
+FILTER_HEADER = struct.Struct('!12xHB5xHxB2xIIHH9xB')
+IPV4_FIELDS = struct.Struct('!B5xHxB2xII')  # version/IHL, fragment field, protocol, addresses
+TCP_FIELDS = struct.Struct('!HH9xB')  # ports and flags
+
+
+class FilterSyntaxError(ValueError):
+    pass
+
+
+# Recursive descent parser that translates a filter expression into one Python expression
+class FilterCompiler:
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = []
+        position = 0
+        while position < len(expression.rstrip()):
+            match = TOKEN.match(expression, position)
+            if not match:
+                raise FilterSyntaxError(f"cannot parse filter at: {expression[position:]!r}")
+            self.tokens.append(match.group(1).lower())
+            position = match.end()
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def take(self, expected=None):
+        token = self.peek()
+        if token is None or (expected is not None and token != expected):
+            raise FilterSyntaxError(f"expected {expected or 'more input'} in filter {self.expression!r}")
+        self.position += 1
+        return token
+
+    def compile(self):
+        if not self.tokens:
+            raise FilterSyntaxError("empty filter")
+        code = self.parse_expr()
+        if self.peek() is not None:
+            raise FilterSyntaxError(f"unexpected {self.peek()!r} in filter {self.expression!r}")
+        return code
+
+    def parse_expr(self):
+        terms = [self.parse_term()]
+        while self.peek() in ('or', '||'):
+            self.take()
+            terms.append(self.parse_term())
+        return terms[0] if len(terms) == 1 else '(' + ' or '.join(terms) + ')'
+
+    def parse_term(self):
+        factors = [self.parse_factor()]
+        while self.peek() in ('and', '&&'):
+            self.take()
+            factors.append(self.parse_factor())
+        return factors[0] if len(factors) == 1 else '(' + ' and '.join(factors) + ')'
+
+    def parse_factor(self):
+        token = self.peek()
+        if token in ('not', '!'):
+            self.take()
+            return f"(not {self.parse_factor()})"
+        if token == '(':
+            self.take()
+            code = self.parse_expr()
+            self.take(')')
+            return code
+        return self.parse_primitive()
+
+    def parse_primitive(self):
+        token = self.take()
+        if token in TCP_FLAGS:
+            return f"(flags & {TCP_FLAGS[token]} != 0)"
+
+        directions = ('src', 'dst')
+        if token in directions:
+            directions = (token,)
+            token = self.take()
+        if token not in FIELDS:
+            raise FilterSyntaxError(f"unknown filter primitive {token!r}")
+        value = self.take()
+        try:
+            tests = [self.compile_test(token, FIELDS[token][direction], value) for direction in directions]
+        except (OSError, ValueError):
+            raise FilterSyntaxError(f"invalid {token} {value!r}") from None
+        return tests[0] if len(tests) == 1 else '(' + ' or '.join(tests) + ')'
+
+    @staticmethod
+    def compile_test(kind, field, value):
+        if kind == 'host':
+            return f"{field} == {int.from_bytes(socket.inet_pton(socket.AF_INET, value), 'big')}"
+        if kind == 'port':
+            port = int(value)
+            if not 0 <= port <= 0xffff:
+                raise ValueError(value)
+            return f"{field} == {port}"
+        address, _, prefix = value.partition('/')
+        prefix = int(prefix) if prefix else 32
+        if not 0 <= prefix <= 32:
+            raise ValueError(value)
+        mask = (0xffffffff << (32 - prefix)) & 0xffffffff
+        network = int.from_bytes(socket.inet_pton(socket.AF_INET, address), 'big') & mask
+        return f"({field} & {mask}) == {network}"
+
+
+# Compiles a filter expression into a predicate on raw Ethernet frames (bytes or memoryview)
+def compile_filter(expression):
+    test = eval(f"lambda src, dst, sport, dport, flags: {FilterCompiler(expression).compile()}", {'__builtins__': {}})
+
+    # Frames with VLAN tags or IP options: locates the headers before reading the fields
+    def matches_general(frame):
+        size = len(frame)
+        ip = 14
+        ethertype = frame[12] << 8 | frame[13] if size >= 14 else None
+        while ethertype in (0x8100, 0x88a8) and size >= ip + 4:  # Skips VLAN tags
+            ethertype = frame[ip + 2] << 8 | frame[ip + 3]
+            ip += 4
+        if ethertype != 0x0800 or size < ip + 20:
+            return False
+        version_ihl, fragment, protocol, src, dst = IPV4_FIELDS.unpack_from(frame, ip)
+        l4 = ip + ((version_ihl & 0x0f) << 2)
+        # IPv4 TCP only, and no non-initial fragments since they carry no TCP header
+        if version_ihl >> 4 != 4 or protocol != 6 or fragment & 0x1fff or size < l4 + 14:
+            return False
+        sport, dport, flags = TCP_FIELDS.unpack_from(frame, l4)
+        return test(src, dst, sport, dport, flags)
+
+    def matches(frame):
+        if len(frame) >= FILTER_HEADER.size:
+            ethertype, version_ihl, fragment, protocol, src, dst, sport, dport, flags = FILTER_HEADER.unpack_from(frame)
+            if ethertype == 0x0800 and version_ihl == 0x45:
+                return protocol == 6 and not fragment & 0x1fff and test(src, dst, sport, dport, flags)
+        return matches_general(frame)
+
+    return matches
@@ -0,0 +1,88 @@
+import time
+
+from analysis_pcap_tcp import (IDLE_TIMEOUT, MAX_LIVE_FLOWS, PCAP_HEADER_LEN, RECORD_HEADER_LEN, FlowTable,
+                               compile_filter, decode_tcp_segment, format_flow_id, read_pcap_header, report_tcp_flow)
+
+READ_SIZE = 1 << 20  # Bytes read from the growing file per attempt
+POLL_INTERVAL = 0.2  # Seconds to wait when the writer has not produced new data
+
+
+# Yields (ts, pkt) for the records of a pcap file that is still being written, never rereading data.
+# Partially written records are kept until the rest arrives. Yields None whenever the reader has
+# caught up with the writer, so the caller can do periodic work while waiting.
+def follow_pcap_file(file_path, poll_interval=POLL_INTERVAL):
+    with open(file_path, 'rb') as file:
+        pending = b''
+        while len(pending) < PCAP_HEADER_LEN:
+            data = file.read(PCAP_HEADER_LEN - len(pending))
+            if not data:
+                yield None
+                time.sleep(poll_interval)
+            pending += data
+        record_header, _, frac_units = read_pcap_header(pending)
+        unpack_from = record_header.unpack_from
+
+        pending = b''
+        while True:
+            data = file.read(READ_SIZE)
+            if not data:
+                yield None
+                time.sleep(poll_interval)
+                continue
+            buf = pending + data if pending else data
+            offset = 0
+            while offset + RECORD_HEADER_LEN <= len(buf):
+                sec, frac, incl_len, _ = unpack_from(buf, offset)
+                end = offset + RECORD_HEADER_LEN + incl_len
+                if end > len(buf):
+                    break  # The writer has not finished this record yet
+                yield sec + frac / frac_units, buf[offset + RECORD_HEADER_LEN:end]
+                offset = end
+            pending = buf[offset:]
+
+
+# Prints what changed in every flow active since the previous progress report. Throughput is measured
+# over the capture time between the flow's last packets then and now, so it stays right when the file
+# is read faster or slower than it was captured, e.g. when catching up with a backlog.
+def report_flow_progress(flows, snapshots):
+    active = [(flow_id, flow) for flow_id, flow in flows.items()
+              if snapshots.get(flow_id, (None,))[0] != flow.end_time]
+    print(f"[{time.strftime('%H:%M:%S')}] {len(active)} active of {len(flows)} live TCP flows")
+    for flow_id, flow in active:
+        end_time, total_bytes, triple_dup_acks, timeouts = snapshots.get(flow_id, (flow.start_time, 0, 0, 0))
+        span = flow.end_time - end_time
+        throughput = (flow.total_bytes - total_bytes) / span if span > 0 else 0
+        print(f"TCP Flow: {format_flow_id(flow_id)}")
+        print(f"\tThroughput (last {span:.3f}s of capture): {throughput:.2f} bytes/sec")
+        print(f"\tNew Triple Duplicate ACKs: {flow.triple_dup_acks - triple_dup_acks}")
+        print(f"\tNew Timeouts: {flow.timeouts - timeouts}")
+        snapshots[flow_id] = (flow.end_time, flow.total_bytes, flow.triple_dup_acks, flow.timeouts)
+    print()
+
+
+# Analyzes a growing pcap file incrementally, reporting flow progress every `interval` seconds.
+# Flows are reported in full and forgotten as soon as they complete; Ctrl-C reports the live ones.
+def follow_pcap(file_path, interval=5.0, idle_timeout=IDLE_TIMEOUT, max_flows=MAX_LIVE_FLOWS, packet_filter=None):
+    matches = compile_filter(packet_filter) if packet_filter else None
+    snapshots = {}  # flow id -> (end time, data bytes, triple dup ACKs, timeouts) at the last report
+
+    def flow_completed(flow_id, flow):
+        snapshots.pop(flow_id, None)
+        report_tcp_flow(flow_id, flow)
+
+    table = FlowTable(flow_completed, idle_timeout, max_flows)
+    last_report = time.monotonic()
+    try:
+        for record in follow_pcap_file(file_path):
+            if record is not None and (matches is None or matches(record[1])):
+                ts, frame = record
+                segment = decode_tcp_segment(frame)
+                if segment is not None:
+                    table.update(ts, segment)
+            now = time.monotonic()
+            if now - last_report >= interval:
+                report_flow_progress(table.flows, snapshots)
+                last_report = now
+    except KeyboardInterrupt:
+        pass
+    table.flush()
@@ -0,0 +1,199 @@
+import argparse
+import heapq
+import random
+import struct
+
+# Deterministic synthetic pcaps for testing and benchmarking the analyzer. Every flow is a bulk
+# transfer captured at the sender: a handshake, rounds of data segments that follow slow start and
+# congestion avoidance, and a FIN. Lost data segments are captured once (they are lost after the
+# capture point) and recovered by fast retransmit after three duplicate ACKs, or by a timeout when
+# not enough segments followed them. Reordered segments and spurious duplicate ACKs can be mixed in.
+
+PCAP_GLOBAL_HEADER = struct.Struct('<IHHiIII')
+PCAP_RECORD_HEADER = struct.Struct('<IIII')
+# Ethernet, option-less IPv4 and option-less TCP headers
+FRAME_HEADER = struct.Struct('!6s6sHBBHHHBBH4s4sHHIIBBHHH')
+IP_HEADER_WORDS = struct.Struct('!10H')
+
+MAC_CLIENT = b'\x02\x00\x00\x00\x00\x01'
+MAC_SERVER = b'\x02\x00\x00\x00\x00\x02'
+SERVER_ADDRESS = bytes([192, 168, 0, 1])
+SERVER_PORT = 80
+RECEIVE_WINDOW = 65535
+
+START_TIME = 1700000000.0
+SEGMENT_GAP = 0.0001  # Seconds between back-to-back data segments
+INITIAL_CWND = 10  # Segments
+RETRANSMIT_TIMEOUT = 1.0  # Seconds before a segment without enough duplicate ACKs is retransmitted
+FIN, SYN, ACK = 0x01, 0x02, 0x10
+
+
+def ip_checksum(header):
+    total = sum(IP_HEADER_WORDS.unpack(header))
+    total = (total & 0xffff) + (total >> 16)
+    total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+
+# Builds an Ethernet/IPv4/TCP frame with a zero-filled payload of `payload_len` bytes
+def tcp_frame(src, dst, sport, dport, seq, ack, flags, payload_len=0):
+    from_client = src != SERVER_ADDRESS
+    header = FRAME_HEADER.pack(MAC_SERVER if from_client else MAC_CLIENT, MAC_CLIENT if from_client else MAC_SERVER,
+                               0x0800, 0x45, 0, 40 + payload_len, 0, 0x4000, 64, 6, 0, src, dst,
+                               sport, dport, seq & 0xffffffff, ack & 0xffffffff, 5 << 4, flags, RECEIVE_WINDOW, 0, 0)
+    checksum = ip_checksum(header[14:34])
+    return header[:24] + checksum.to_bytes(2, 'big') + header[26:] + bytes(payload_len)
+
+
+# Yields the (ts, frame) records of one flow in time order
+def simulate_flow(index, start, packets, loss, reorder, dup_acks, payload_size, seed, isn=None, recoveries=None):
+    rng = random.Random(f"{seed}:{index}")
+    client = bytes([10, (index + 1) >> 16 & 0xff, (index + 1) >> 8 & 0xff, (index + 1) & 0xff])
+    client_port = 1024 + index % 64000
+    rtt = rng.uniform(0.005, 0.1)
+    client_isn = rng.randrange(1 << 30)
+    server_isn = rng.randrange(1 << 30)
+    if isn is not None:
+        client_isn = isn  # Drawn anyway, so the rest of the flow does not depend on the ISN
+
+    def data(ts, segment):
+        return ts, tcp_frame(client, SERVER_ADDRESS, client_port, SERVER_PORT,
+                             client_isn + 1 + segment * payload_size, server_isn + 1, ACK, payload_size)
+
+    def ack(ts, segment):
+        return ts, tcp_frame(SERVER_ADDRESS, client, SERVER_PORT, client_port,
+                             server_isn + 1, client_isn + 1 + segment * payload_size, ACK)
+
+    yield start, tcp_frame(client, SERVER_ADDRESS, client_port, SERVER_PORT, client_isn, 0, SYN)
+    t = start + rtt
+    yield t, tcp_frame(SERVER_ADDRESS, client, SERVER_PORT, client_port, server_isn, client_isn + 1, SYN | ACK)
+    yield t, tcp_frame(client, SERVER_ADDRESS, client_port, SERVER_PORT, client_isn + 1, server_isn + 1, ACK)
+
+    cwnd, ssthresh = INITIAL_CWND, RECEIVE_WINDOW // payload_size
+    acked = 0  # Segments cumulatively acknowledged
+    while acked < packets:
+        window = range(acked, min(acked + cwnd, packets))
+        records = [data(t + i * SEGMENT_GAP, segment) for i, segment in enumerate(window)]
+        arrivals = [segment for segment in window if rng.random() >= loss]
+        for i in range(len(arrivals) - 1):
+            if rng.random() < reorder:
+                arrivals[i], arrivals[i + 1] = arrivals[i + 1], arrivals[i]
+
+        # Receiver: cumulative ACK for every arriving segment, duplicates while a hole is open
+        received = set()
+        expected = acked
+        dup_ack_times = []
+        ack_time = t
+        for segment in arrivals:
+            ack_time = max(ack_time, t + (segment - acked) * SEGMENT_GAP + rtt)
+            received.add(segment)
+            if segment == expected:
+                while expected in received:
+                    expected += 1
+            else:
+                dup_ack_times.append(ack_time)
+            records.append(ack(ack_time, expected))
+            if rng.random() < dup_acks:
+                ack_time += SEGMENT_GAP
+                records.append(ack(ack_time, expected))
+
+        # Sender: recovers the holes one at a time, then adapts cwnd
+        timed_out = fast_retransmit = False
+        while expected < window.stop:
+            if not fast_retransmit and not timed_out and len(dup_ack_times) >= 3:
+                fast_retransmit = True
+                if recoveries is not None:
+                    flow_id = (client, client_port, SERVER_ADDRESS, SERVER_PORT)
+                    recoveries[flow_id] = recoveries.get(flow_id, 0) + 1
+                retransmit_time = dup_ack_times[2] + SEGMENT_GAP
+            elif fast_retransmit or timed_out:
+                retransmit_time = ack_time + SEGMENT_GAP  # Partial ACK: retransmits the next hole right away
+            else:
+                timed_out = True
+                retransmit_time = max(ack_time, t + (expected - acked) * SEGMENT_GAP + RETRANSMIT_TIMEOUT)
+            records.append(data(retransmit_time, expected))
+            received.add(expected)
+            while expected in received:
+                expected += 1
+            ack_time = max(ack_time, retransmit_time) + rtt
+            records.append(ack(ack_time, expected))
+
+        if timed_out:
+            ssthresh, cwnd = max(cwnd // 2, 2), 1
+        elif fast_retransmit:
+            ssthresh = cwnd = max(cwnd // 2, 2)
+        else:
+            cwnd = min(cwnd * 2 if cwnd < ssthresh else cwnd + 1, RECEIVE_WINDOW // payload_size)
+        records.sort(key=lambda record: record[0])
+        yield from records
+        acked = window.stop
+        t = ack_time
+
+    fin_seq = client_isn + 1 + packets * payload_size
+    yield t, tcp_frame(client, SERVER_ADDRESS, client_port, SERVER_PORT, fin_seq, server_isn + 1, FIN | ACK)
+    yield t + rtt, tcp_frame(SERVER_ADDRESS, client, SERVER_PORT, client_port, server_isn + 1, fin_seq + 1, FIN | ACK)
+    yield t + rtt, tcp_frame(client, SERVER_ADDRESS, client_port, SERVER_PORT, fin_seq + 1, server_isn + 2, ACK)
+
+
+# Writes a synthetic capture of `flows` concurrent bulk transfers of `packets` data segments each.
+# The same arguments always produce the same file. With `isn`, every client starts its sequence
+# numbers there, e.g. just below 2^32 to make them wrap. A `recoveries` dict receives the number of
+# fast retransmits of every client flow that had one, keyed by its raw (src, sport, dst, dport).
+# Returns the number of records written.
+def generate_pcap(file_path, flows=10, packets=1000, loss=0.0, reorder=0.0, dup_acks=0.0, payload_size=1460,
+                  seed=0, flow_interval=0.05, isn=None, recoveries=None):
+    rng = random.Random(seed)
+    starts = []
+    start = START_TIME
+    for _ in range(flows):
+        starts.append(start)
+        start += rng.expovariate(1 / flow_interval)
+    streams = [simulate_flow(index, starts[index], packets, loss, reorder, dup_acks, payload_size, seed, isn,
+                             recoveries)
+               for index in range(flows)]
+
+    count = 0
+    with open(file_path, 'wb') as file:
+        file.write(PCAP_GLOBAL_HEADER.pack(0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+        chunk = []
+        for ts, frame in heapq.merge(*streams, key=lambda record: record[0]):
+            usec = round(ts * 1e6)
+            chunk.append(PCAP_RECORD_HEADER.pack(usec // 1000000, usec % 1000000, len(frame), len(frame)))
+            chunk.append(frame)
+            count += 1
+            if len(chunk) >= 8192:
+                file.write(b''.join(chunk))
+                chunk.clear()
+        file.write(b''.join(chunk))
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a deterministic synthetic TCP pcap file")
+    parser.add_argument('pcap_file', help="output pcap file")
+    parser.add_argument('--flows', type=int, default=10, help="number of TCP connections (default: 10)")
+    parser.add_argument('--packets', type=int, default=1000, help="data segments per flow (default: 1000)")
+    parser.add_argument('--loss', type=float, default=0.0, help="probability that a data segment is lost")
+    parser.add_argument('--reorder', type=float, default=0.0,
+                        help="probability that a data segment arrives after the next one")
+    parser.add_argument('--dup-acks', type=float, default=0.0,
+                        help="probability that the receiver repeats an ACK without a loss")
+    parser.add_argument('--payload-size', type=int, default=1460, help="bytes of data per segment (default: 1460)")
+    parser.add_argument('--flow-interval', type=float, default=0.05,
+                        help="mean seconds between the starts of consecutive flows (default: 0.05)")
+    parser.add_argument('--seed', type=int, default=0, help="random seed (default: 0)")
+    parser.add_argument('--isn', type=int,
+                        help="initial sequence number of every client, e.g. 4294967000 to wrap (default: random)")
+    args = parser.parse_args()
+    if not 0 < args.payload_size <= 1460:
+        parser.error("--payload-size must be between 1 and 1460")
+    if args.isn is not None and not 0 <= args.isn <= 0xffffffff:
+        parser.error("--isn must be between 0 and 4294967295")
+
+    count = generate_pcap(args.pcap_file, args.flows, args.packets, args.loss, args.reorder, args.dup_acks,
+                          args.payload_size, args.seed, args.flow_interval, args.isn)
+    print(f"Wrote {count} packets to {args.pcap_file}")
+
+
+if __name__ == "__main__":
+    main()
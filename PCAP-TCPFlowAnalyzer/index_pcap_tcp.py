@@ -0,0 +1,150 @@
+import heapq
+import mmap
+import os
+import socket
+import struct
+import sys
+from array import array
+
+from analysis_pcap_tcp import (PCAP_HEADER_LEN, RECORD_HEADER_LEN, aggregate_tcp_segments, decode_tcp_segment,
+                               flow_key, iter_pcap_mmap, read_pcap_header)
+
+INDEX_SUFFIX = '.flowidx'
+INDEX_MAGIC = b'PCAPFLOWIDX1'
+# magic, size and mtime (ns) of the indexed pcap, number of flows
+INDEX_HEADER = struct.Struct('<12sQQI')
+# flow key, start time, end time, TCP data bytes, packet count, position of the first offset
+INDEX_ENTRY = struct.Struct('<12sddQIQ')
+OFFSET_SIZE = 8  # Record offsets follow the entries as little-endian uint64
+
+
+# Parses "SRC:SPORT,DST:DPORT" into a flow id with raw addresses. Raises ValueError when malformed.
+def parse_flow_id(text):
+    endpoints = text.split(',')
+    if len(endpoints) != 2:
+        raise ValueError(f"expected SRC:SPORT,DST:DPORT, got {text!r}")
+    flow_id = []
+    for endpoint in endpoints:
+        host, separator, port = endpoint.strip().rpartition(':')
+        if not separator or not (port.isascii() and port.isdigit()) or int(port) > 65535:
+            raise ValueError(f"expected IPv4 address:port (0-65535), got {endpoint.strip()!r}")
+        try:
+            flow_id += [socket.inet_pton(socket.AF_INET, host), int(port)]
+        except OSError:
+            raise ValueError(f"invalid IPv4 address {host!r}") from None
+    return tuple(flow_id)
+
+
+def default_index_path(pcap_path):
+    return pcap_path + INDEX_SUFFIX
+
+
+# Scans a pcap once and writes a sidecar mapping every flow to its summary and record offsets
+def build_flow_index(pcap_path, index_path=None):
+    index_path = index_path or default_index_path(pcap_path)
+    stat = os.stat(pcap_path)
+
+    flows = {}  # flow key -> [start time, end time, total bytes, record offsets]
+    offset = PCAP_HEADER_LEN
+    for ts, frame in iter_pcap_mmap(pcap_path):
+        segment = decode_tcp_segment(frame)
+        if segment is not None:
+            key = flow_key(segment[:4])
+            summary = flows.get(key)
+            if summary is None:
+                summary = flows[key] = [ts, ts, 0, array('Q')]
+            summary[1] = ts
+            summary[2] += segment[8]
+            summary[3].append(offset)
+        offset += RECORD_HEADER_LEN + len(frame)
+
+    # Entries are sorted by key so a query can binary search them without loading the table
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'wb') as index_file:
+        index_file.write(INDEX_HEADER.pack(INDEX_MAGIC, stat.st_size, stat.st_mtime_ns, len(flows)))
+        position = 0
+        for key in sorted(flows):
+            start_time, end_time, total_bytes, offsets = flows[key]
+            index_file.write(INDEX_ENTRY.pack(key, start_time, end_time, total_bytes, len(offsets), position))
+            position += len(offsets)
+        for key in sorted(flows):
+            offsets = flows[key][3]
+            if sys.byteorder != 'little':
+                offsets.byteswap()
+            index_file.write(offsets.tobytes())
+    os.replace(tmp_path, index_path)
+    return index_path
+
+
+# Opens the sidecar of a pcap, (re)building it when it is missing or the pcap has changed
+def open_flow_index(pcap_path, index_path=None):
+    index_path = index_path or default_index_path(pcap_path)
+    stat = os.stat(pcap_path)
+    for _ in range(2):
+        if os.path.isfile(index_path):
+            with open(index_path, 'rb') as index_file:
+                index = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, size, mtime_ns, _ = INDEX_HEADER.unpack_from(index)
+            if magic == INDEX_MAGIC and size == stat.st_size and mtime_ns == stat.st_mtime_ns:
+                return index
+            index.close()
+        build_flow_index(pcap_path, index_path)
+    raise ValueError(f"could not build a flow index for {pcap_path}")
+
+
+# Binary searches the index for a flow and returns its entry, or None
+def find_flow_entry(index, flow_id):
+    key = flow_key(flow_id)
+    count = INDEX_HEADER.unpack_from(index)[3]
+    low, high = 0, count
+    while low < high:
+        middle = (low + high) // 2
+        entry = INDEX_ENTRY.unpack_from(index, INDEX_HEADER.size + middle * INDEX_ENTRY.size)
+        if entry[0] < key:
+            low = middle + 1
+        elif entry[0] > key:
+            high = middle
+        else:
+            return entry
+    return None
+
+
+# Returns the record offsets of a flow from the index (empty when the flow is unknown)
+def flow_offsets(index, flow_id):
+    entry = find_flow_entry(index, flow_id)
+    if entry is None:
+        return array('Q')
+    _, _, _, _, packet_count, position = entry
+    offsets_start = INDEX_HEADER.size + INDEX_HEADER.unpack_from(index)[3] * INDEX_ENTRY.size
+    offsets = array('Q', index[offsets_start + position * OFFSET_SIZE:
+                              offsets_start + (position + packet_count) * OFFSET_SIZE])
+    if sys.byteorder != 'little':
+        offsets.byteswap()
+    return offsets
+
+
+# Yields (ts, segment) for the records at the given offsets of a pcap file
+def iter_indexed_segments(pcap, offsets):
+    record_header, _, frac_units = read_pcap_header(pcap)
+    for offset in offsets:
+        sec, frac, incl_len, _ = record_header.unpack_from(pcap, offset)
+        data_start = offset + RECORD_HEADER_LEN
+        yield sec + frac / frac_units, decode_tcp_segment(pcap[data_start:data_start + incl_len])
+
+
+# Rebuilds the FlowState of one flow by reading only the records of its connection.
+# The reverse direction is read as well, since its ACKs drive the RTT and timeout analysis.
+def query_flow(pcap_path, flow_id, index_path=None):
+    src, sport, dst, dport = flow_id
+    index = open_flow_index(pcap_path, index_path)
+    try:
+        offsets = flow_offsets(index, flow_id)
+        reverse_offsets = flow_offsets(index, (dst, dport, src, sport))
+    finally:
+        index.close()
+    if not offsets:
+        return None
+
+    with open(pcap_path, 'rb') as pcap_file, mmap.mmap(pcap_file.fileno(), 0, access=mmap.ACCESS_READ) as pcap:
+        flows = aggregate_tcp_segments(iter_indexed_segments(pcap, heapq.merge(offsets, reverse_offsets)))
+    return flows[flow_id]
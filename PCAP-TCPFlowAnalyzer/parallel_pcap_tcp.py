@@ -0,0 +1,108 @@
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+from analysis_pcap_tcp import (PCAP_HEADER_LEN, RECORD_HEADER_LEN, aggregate_tcp_segments, decode_tcp_segment,
+                               filter_raw_packets, iter_pcap_mmap, read_pcap_header, report_tcp_flows)
+
+# Compact spill format of one decoded segment: ts, src, sport, dst, dport, seq, ack, flags, win, payload_len
+SEGMENT_RECORD = struct.Struct('=d4sH4sHIIHHI')
+SPILL_BYTES = 1 << 20  # Buffered spill data per shard before it is written out
+
+
+# Deterministically assigns a connection to one of `shards` partitions; both directions share a shard
+def flow_shard(src, sport, dst, dport, shards):
+    return zlib.crc32(src + dst if src < dst else dst + src, sport ^ dport) % shards
+
+
+# Splits a pcap file into up to `parts` byte ranges that start on record boundaries. The record
+# headers are walked from the start of the file, which only reads 16 bytes per record, because
+# guessing a boundary in the middle of the file can be fooled by payload bytes that look like headers.
+def split_pcap_file(file_path, parts):
+    with open(file_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        record_header, _, _ = read_pcap_header(buf)
+        unpack_from = record_header.unpack_from
+        size = len(buf)
+        targets = [PCAP_HEADER_LEN + part * (size - PCAP_HEADER_LEN) // parts for part in range(1, parts)]
+        cuts = [PCAP_HEADER_LEN]
+        offset = PCAP_HEADER_LEN
+        for target in targets:
+            while offset < target and offset + RECORD_HEADER_LEN <= size:
+                offset += RECORD_HEADER_LEN + unpack_from(buf, offset)[2]
+            cuts.append(min(offset, size))
+        cuts.append(size)
+    return [(start, end) for start, end in zip(cuts, cuts[1:]) if start < end]
+
+
+# Phase 1 worker: decodes one byte range and spills its segments into one file per flow shard.
+# Returns the (first, last) timestamp of the spilled segments, or None when there were none.
+def partition_pcap_range(file_path, start, end, shards, spill_prefix, packet_filter=None):
+    spill_files = [open(f"{spill_prefix}.{shard}", 'wb') for shard in range(shards)]
+    buffers = [bytearray() for _ in range(shards)]
+    first_ts = last_ts = None
+    try:
+        for ts, frame in filter_raw_packets(iter_pcap_mmap(file_path, start, end), packet_filter):
+            segment = decode_tcp_segment(frame)
+            if segment is None:
+                continue
+            if first_ts is None or ts < first_ts:
+                first_ts = ts
+            if last_ts is None or ts > last_ts:
+                last_ts = ts
+            shard = flow_shard(segment[0], segment[1], segment[2], segment[3], shards)
+            buffer = buffers[shard]
+            buffer += SEGMENT_RECORD.pack(ts, *segment)
+            if len(buffer) >= SPILL_BYTES:
+                spill_files[shard].write(buffer)
+                buffer.clear()
+        for spill_file, buffer in zip(spill_files, buffers):
+            spill_file.write(buffer)
+    finally:
+        for spill_file in spill_files:
+            spill_file.close()
+    return None if first_ts is None else (first_ts, last_ts)
+
+
+# Yields (ts, segment) from spill files, in the order the files are given
+def iter_spilled_segments(spill_paths):
+    chunk_size = SEGMENT_RECORD.size * 65536
+    for path in spill_paths:
+        with open(path, 'rb') as spill_file:
+            while True:
+                data = spill_file.read(chunk_size)
+                if not data:
+                    break
+                for record in SEGMENT_RECORD.iter_unpack(data):
+                    yield record[0], record[1:]
+
+
+# Phase 2 worker: aggregates every flow of one shard from its spill files in capture order
+def aggregate_shard(spill_paths):
+    return aggregate_tcp_segments(iter_spilled_segments(spill_paths))
+
+
+# Aggregates the flows of a pcap file on `jobs` processes, with the same result as the sequential analyzer.
+# Phase 1 decodes byte ranges of the file in parallel and partitions the segments by flow;
+# phase 2 aggregates each flow partition in parallel, so no flow state is ever split.
+def aggregate_pcap_parallel(file_path, jobs=None, packet_filter=None):
+    jobs = jobs or os.cpu_count()
+    ranges = split_pcap_file(file_path, jobs)
+    flows = {}
+    with tempfile.TemporaryDirectory(prefix='pcap-shards-') as spill_dir, ProcessPoolExecutor(jobs) as pool:
+        prefixes = [os.path.join(spill_dir, f"range{i}") for i in range(len(ranges))]
+        list(pool.map(partition_pcap_range, [file_path] * len(ranges), [start for start, _ in ranges],
+                      [end for _, end in ranges], [jobs] * len(ranges), prefixes, [packet_filter] * len(ranges)))
+
+        shard_paths = [[f"{prefix}.{shard}" for prefix in prefixes] for shard in range(jobs)]
+        for shard_flows in pool.map(aggregate_shard, shard_paths):
+            flows.update(shard_flows)
+
+    # Restores the order in which flows first appeared in the capture
+    return dict(sorted(flows.items(), key=lambda item: item[1].start_time))
+
+
+def analyze_pcap_parallel(file_path, jobs=None, packet_filter=None):
+    report_tcp_flows(aggregate_pcap_parallel(file_path, jobs, packet_filter))
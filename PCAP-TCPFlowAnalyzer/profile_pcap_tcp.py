@@ -0,0 +1,203 @@
+import cProfile
+import contextlib
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from itertools import islice
+
+from analysis_pcap_tcp import (aggregate_tcp_flows, aggregate_tcp_segments, filter_raw_packets, filter_tcp_packets,
+                               iter_pcap_mmap, iter_tcp_segments, read_pcap_file, report_tcp_flows)
+
+PROFILE_BATCH = 4096  # Items pulled from a lazy stage per timed step, to keep the timer overhead negligible
+
+
+class StageStats:
+    __slots__ = ('name', 'unit', 'seconds', 'child_seconds', 'peak_memory', 'items', 'bytes', 'entered',
+                 'entered_memory')
+
+    def __init__(self, name, unit):
+        self.name = name
+        self.unit = unit  # What the stage outputs: packets or flows
+        self.seconds = 0.0  # Inclusive of the upstream stages it pulled from
+        self.child_seconds = 0.0
+        self.peak_memory = None  # Most traced bytes held above the level at entry, exclusive; None if not traced
+        self.items = 0
+        self.bytes = 0
+        self.entered = None
+        self.entered_memory = 0
+
+    def as_dict(self):
+        seconds = self.seconds - self.child_seconds
+        return {'stage': self.name, 'seconds': round(seconds, 6), self.unit: self.items,
+                f"{self.unit}_per_sec": round(self.items / seconds, 1) if seconds > 0 else None,
+                'bytes': self.bytes,
+                'peak_allocated_kib': None if self.peak_memory is None else round(self.peak_memory / 1024, 1)}
+
+
+# Attributes wall time to nested stages. Time a stage spends pulling from an upstream stage is
+# charged to the upstream stage, so each stage reports its own work. When a cProfile.Profile is
+# given, it only runs while `target` is the innermost active stage. With `memory`, tracemalloc
+# must be tracing, and each stage records the most memory it allocated above its level at entry.
+class StageProfiler:
+    def __init__(self, profile=None, target=None, memory=False):
+        self.active = []
+        self.profile = profile
+        self.target = target
+        self.memory = memory
+
+    # Folds the traced peak since the last reset into the innermost stage, then resets the peak
+    def record_peak(self):
+        current, peak = tracemalloc.get_traced_memory()
+        if self.active:
+            stage = self.active[-1]
+            stage.peak_memory = max(stage.peak_memory or 0, peak - stage.entered_memory)
+        tracemalloc.reset_peak()
+        return current
+
+    def enter(self, stage):
+        if self.profile is not None and self.active and self.active[-1] is self.target:
+            self.profile.disable()
+        if self.memory:
+            stage.entered_memory = self.record_peak()
+        self.active.append(stage)
+        stage.entered = time.perf_counter()
+        if stage is self.target:
+            self.profile.enable()
+
+    def exit(self):
+        if self.active[-1] is self.target:
+            self.profile.disable()
+        elapsed = time.perf_counter() - self.active[-1].entered
+        if self.memory:
+            self.record_peak()
+        stage = self.active.pop()
+        stage.seconds += elapsed
+        if self.active:
+            parent = self.active[-1]
+            parent.child_seconds += elapsed
+            if parent is self.target:
+                self.profile.enable()
+
+    # Yields the items of a lazy stage, pulling them in timed batches
+    def iterate(self, stage, iterable, size):
+        iterator = iter(iterable)
+        while True:
+            self.enter(stage)
+            try:
+                batch = list(islice(iterator, PROFILE_BATCH))
+            finally:
+                self.exit()
+            stage.items += len(batch)
+            if size is not None:
+                stage.bytes += sum(map(size, batch))
+            yield from batch
+            if len(batch) < PROFILE_BATCH:
+                return
+
+    # Runs `function(data)` as a stage; lazy results are wrapped so that consuming them is timed too
+    def run(self, stage, function, data, size):
+        self.enter(stage)
+        try:
+            result = function(data)
+        finally:
+            self.exit()
+        if hasattr(result, '__next__'):
+            return self.iterate(stage, result, size)
+        if result is not None:
+            stage.items += len(result)
+            if size is not None:
+                stage.bytes += sum(map(size, result))
+        return result
+
+
+def frame_size(packet):
+    return len(packet[1])
+
+
+# (name, unit, function, bytes of an output item) for each stage of an analysis mode
+def pipeline_stages(file_path, packet_filter=None, in_memory=False):
+    if in_memory:
+        stages = [('read', 'packets', lambda _: read_pcap_file(file_path), frame_size),
+                  ('filter', 'packets', lambda packets: filter_raw_packets(packets, packet_filter), frame_size),
+                  ('decode', 'packets', filter_tcp_packets, lambda packet: len(packet[1].data.data.data)),
+                  ('aggregate', 'flows', aggregate_tcp_flows, None)]
+    else:
+        stages = [('read', 'packets', lambda _: iter_pcap_mmap(file_path), frame_size),
+                  ('filter', 'packets', lambda packets: filter_raw_packets(packets, packet_filter), frame_size),
+                  ('decode', 'packets', iter_tcp_segments, lambda segment: segment[1][8]),
+                  ('aggregate', 'flows', aggregate_tcp_segments, None)]
+    if not packet_filter:
+        stages = [stage for stage in stages if stage[0] != 'filter']
+    # Per-flow metrics are computed incrementally during aggregation; this stage finalizes and reports them
+    return stages + [('report', 'flows', report_tcp_flows, None)]
+
+
+# Runs the stages with the report written to devnull, so that `--profile -` stays valid JSON
+def run_pipeline(stages, stats, profiler):
+    data = None
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for stage, (_, _, function, size) in zip(stats, stages):
+            data = profiler.run(stage, function, data, size)
+    if stats[-1].name == 'report':
+        stats[-1].items = stats[-2].items
+
+
+# Analyzes a pcap like the default (or --in-memory) mode while measuring every stage. Returns a
+# JSON-serializable profile. Allocations are traced in a second pass, since tracemalloc slows the
+# run down; with `cprofile_path`, the hottest stage is profiled in a third pass.
+def profile_pcap_file(file_path, packet_filter=None, in_memory=False, cprofile_path=None):
+    stages = pipeline_stages(file_path, packet_filter, in_memory)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    stats = [StageStats(name, unit) for name, unit, _, _ in stages]
+    start = time.perf_counter()
+    run_pipeline(stages, stats, StageProfiler())
+    wall_seconds = time.perf_counter() - start
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_seconds = (usage_after.ru_utime - usage.ru_utime) + (usage_after.ru_stime - usage.ru_stime)
+
+    tracemalloc.start()
+    try:
+        memory_stats = [StageStats(name, unit) for name, unit, _, _ in stages]
+        run_pipeline(stages, memory_stats, StageProfiler(memory=True))
+    finally:
+        tracemalloc.stop()
+    for stage, memory_stage in zip(stats, memory_stats):
+        stage.peak_memory = memory_stage.peak_memory
+
+    stage_profiles = [stage.as_dict() for stage in stats]
+    hottest = max(range(len(stats)), key=lambda i: stage_profiles[i]['seconds'])
+    document = {
+        'file': file_path,
+        'file_bytes': os.path.getsize(file_path),
+        'mode': 'in-memory' if in_memory else 'streaming',
+        'packet_filter': packet_filter,
+        'wall_seconds': round(wall_seconds, 6),
+        'cpu_seconds': round(cpu_seconds, 6),
+        # Wall time not spent on the CPU, mostly waiting for the disk
+        'io_wait_seconds': round(max(wall_seconds - cpu_seconds, 0.0), 6),
+        'major_page_faults': usage_after.ru_majflt - usage.ru_majflt,
+        'block_input_operations': usage_after.ru_inblock - usage.ru_inblock,
+        'peak_rss_kib': usage_after.ru_maxrss // 1024 if sys.platform == 'darwin' else usage_after.ru_maxrss,
+        'stages': stage_profiles,
+        'hottest_stage': stats[hottest].name,
+    }
+
+    if cprofile_path:
+        profile = cProfile.Profile()
+        stats = [StageStats(name, unit) for name, unit, _, _ in stages]
+        run_pipeline(stages, stats, StageProfiler(profile, stats[hottest]))
+        profile.dump_stats(cprofile_path)
+        document['cprofile'] = {'stage': stats[hottest].name, 'path': cprofile_path}
+    return document
+
+
+def write_profile(document, path):
+    text = json.dumps(document, indent=2)
+    if path == '-':
+        print(text)
+    else:
+        with open(path, 'w') as profile_file:
+            profile_file.write(text + '\n')
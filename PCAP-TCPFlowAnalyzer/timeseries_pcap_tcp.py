@@ -0,0 +1,132 @@
+import csv
+import os
+from itertools import repeat
+
+import numpy as np
+
+from columnar_pcap_tcp import TH_ACK, TH_SYN, flow_id_of_row, group_packets, read_packet_table
+
+DEFAULT_BIN_INTERVAL = 1.0  # Seconds per throughput bin
+
+
+# Minimum and maximum of `values` per group over the rows of a group-sorted array; NaN for empty groups
+def group_extremes(values, row_group, groups):
+    low, high = np.full(groups, np.nan), np.full(groups, np.nan)
+    if len(values):
+        first = np.flatnonzero(np.concatenate([[True], row_group[1:] != row_group[:-1]]))
+        low[row_group[first]] = np.minimum.reduceat(values, first)
+        high[row_group[first]] = np.maximum.reduceat(values, first)
+    return low, high
+
+
+# RTT of every flow from the handshake: its SYN to the SYN/ACK of the reverse flow (NaN without one)
+def handshake_rtts(packets, starts, group):
+    handshake_flags = packets['flags'] & (TH_SYN | TH_ACK)
+    syn = handshake_flags == TH_SYN
+    syn_ack = handshake_flags == TH_SYN | TH_ACK
+    syn_ts, _ = group_extremes(packets['ts'][syn], group[syn], len(starts))
+    syn_ack_ts, _ = group_extremes(packets['ts'][syn_ack], group[syn_ack], len(starts))
+
+    keys = list(zip(packets['src'][starts].tolist(), packets['sport'][starts].tolist(),
+                    packets['dst'][starts].tolist(), packets['dport'][starts].tolist()))
+    flow_groups = {key: g for g, key in enumerate(keys)}
+    rtts = np.full(len(starts), np.nan)
+    for g in np.flatnonzero(~np.isnan(syn_ts)):
+        src, sport, dst, dport = keys[g]
+        reverse = flow_groups.get((dst, dport, src, sport))
+        if reverse is not None and syn_ack_ts[reverse] > syn_ts[g]:
+            rtts[g] = syn_ack_ts[reverse] - syn_ts[g]
+    return rtts
+
+
+# Sums `weights` into consecutive bins per flow; `bins_per_flow` fixes how many bins each flow gets.
+# Returns the per-flow bin offsets and the totals, so flow g owns totals[offsets[g]:offsets[g + 1]].
+def bin_by_flow(row_group, row_bin, weights, bins_per_flow):
+    offsets = np.concatenate([[0], np.cumsum(bins_per_flow)])
+    totals = np.bincount(offsets[row_group] + row_bin, weights=weights, minlength=offsets[-1])
+    return offsets, totals
+
+
+# Computes the full time series of every flow with data, in order of appearance:
+# throughput per `interval` seconds from the flow's first packet to its last, and the estimated
+# cwnd (bytes and packets sent) per RTT round that sent data, counted from its first data packet
+# with the handshake RTT.
+def compute_flow_timeseries(table, interval=DEFAULT_BIN_INTERVAL):
+    if len(table) == 0:
+        return []
+
+    order, packets, starts, group = group_packets(table)
+    ts = packets['ts']
+    payload_len = packets['payload_len'].astype('f8')
+    start_time = np.minimum.reduceat(ts, starts)
+    end_time = np.maximum.reduceat(ts, starts)
+
+    # Throughput: every packet falls into bin floor((ts - flow start) / interval)
+    row_bin = ((ts - start_time[group]) // interval).astype('i8')
+    bins_per_flow = ((end_time - start_time) // interval).astype('i8') + 1
+    bin_offsets, bin_bytes = bin_by_flow(group, row_bin, payload_len, bins_per_flow)
+
+    # cwnd: data packets fall into round floor((ts - first data) / rtt) of their flow. Only the rounds
+    # that sent data are kept, so an idle flow with a short RTT does not allocate every empty round.
+    rtts = handshake_rtts(packets, starts, group)
+    has_data = packets['payload_len'] > 0
+    data_group = group[has_data]
+    data_ts = ts[has_data]
+    first_data, _ = group_extremes(data_ts, data_group, len(starts))
+    counted = (~np.isnan(rtts) & ~np.isnan(first_data))[data_group]
+    counted_group = data_group[counted]
+    row_round = ((data_ts[counted] - first_data[counted_group]) // rtts[counted_group]).astype('i8')
+    rounds, round_index = np.unique(np.stack([counted_group, row_round], axis=1), axis=0, return_inverse=True)
+    round_index = round_index.reshape(-1)
+    round_bytes = np.bincount(round_index, weights=payload_len[has_data][counted], minlength=len(rounds))
+    round_packets = np.bincount(round_index, minlength=len(rounds))
+    round_offsets = np.searchsorted(rounds[:, 0], np.arange(len(starts) + 1))  # Rounds are sorted by flow
+
+    total_bytes = np.add.reduceat(payload_len, starts)
+    flows = []
+    for g in np.argsort(order[starts]):
+        if total_bytes[g] == 0:
+            continue
+        bins = bin_bytes[bin_offsets[g]:bin_offsets[g + 1]]
+        flows.append({
+            'flow_id': flow_id_of_row(packets, starts[g]),
+            'start_time': float(start_time[g]),
+            'interval': interval,
+            'bin_bytes': bins.astype('i8'),
+            'throughput': bins / interval,
+            'rtt': None if np.isnan(rtts[g]) else float(rtts[g]),
+            'first_data_time': None if np.isnan(first_data[g]) else float(first_data[g]),
+            'cwnd_round': rounds[round_offsets[g]:round_offsets[g + 1], 1],
+            'cwnd': round_bytes[round_offsets[g]:round_offsets[g + 1]].astype('i8'),
+            'cwnd_packets': round_packets[round_offsets[g]:round_offsets[g + 1]].astype('i8'),
+        })
+    return flows
+
+
+# Writes the time series as two long-format CSV files, one row per flow and bin or round, ready for plotting
+def write_timeseries_csv(flows, directory):
+    os.makedirs(directory, exist_ok=True)
+    throughput_path = os.path.join(directory, 'throughput.csv')
+    cwnd_path = os.path.join(directory, 'cwnd.csv')
+    with open(throughput_path, 'w', newline='') as throughput_file, open(cwnd_path, 'w', newline='') as cwnd_file:
+        throughput_csv = csv.writer(throughput_file)
+        cwnd_csv = csv.writer(cwnd_file)
+        throughput_csv.writerow(['src', 'sport', 'dst', 'dport', 'start', 'offset', 'bytes', 'throughput'])
+        cwnd_csv.writerow(['src', 'sport', 'dst', 'dport', 'round', 'start', 'offset', 'rtt', 'packets', 'bytes'])
+        for flow in flows:
+            flow_id = flow['flow_id']
+            offsets = np.arange(len(flow['bin_bytes'])) * flow['interval']
+            throughput_csv.writerows(zip(*(repeat(field) for field in flow_id), (flow['start_time'] + offsets).tolist(),
+                                         offsets.tolist(), flow['bin_bytes'].tolist(), flow['throughput'].tolist()))
+            if flow['rtt'] is not None:
+                rounds = flow['cwnd_round']
+                round_offsets = flow['first_data_time'] - flow['start_time'] + rounds * flow['rtt']
+                cwnd_csv.writerows(zip(*(repeat(field) for field in flow_id), rounds.tolist(),
+                                       (flow['start_time'] + round_offsets).tolist(), round_offsets.tolist(),
+                                       repeat(flow['rtt']), flow['cwnd_packets'].tolist(), flow['cwnd'].tolist()))
+    return throughput_path, cwnd_path
+
+
+# Builds the packet table of a pcap file and exports the time series of its flows
+def export_pcap_timeseries(file_path, directory, interval=DEFAULT_BIN_INTERVAL):
+    return write_timeseries_csv(compute_flow_timeseries(read_packet_table(file_path), interval), directory)
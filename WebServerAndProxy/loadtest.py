@@ -0,0 +1,313 @@
+"""
+CSE 310
+Taein Um
+112348159
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+HOST = '127.0.0.1'  # Load is only ever generated over loopback
+HERE = os.path.dirname(os.path.abspath(__file__))
+SIZE_UNITS = {'': 1, 'k': 1 << 10, 'm': 1 << 20}
+DEFAULT_MIX = '1k:70,64k:25,1m:5'  # size:weight of the files requested
+STARTUP_TIMEOUT = 10.0  # Seconds to wait for a launched server to accept connections
+REQUEST_TIMEOUT = 30.0  # Seconds before a request is counted as failed
+
+
+def parse_size(text):
+    text = text.strip().lower()
+    number, unit = (text[:-1], text[-1]) if text[-1:] in SIZE_UNITS else (text, '')
+    return int(number) * SIZE_UNITS[unit]
+
+
+# Parses a request mix such as '1k:70,64k:25,1m:5' into a list of (file size, weight)
+def parse_mix(text):
+    mix = []
+    for item in text.split(','):
+        size, _, weight = item.partition(':')
+        mix.append((parse_size(size), float(weight or 1)))
+    return mix
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind((HOST, 0))
+        return probe.getsockname()[1]
+
+
+def wait_for_port(port, process=None):
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"server on port {port} exited with status {process.returncode}")
+        try:
+            socket.create_connection((HOST, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"nothing is listening on port {port}")
+
+
+# Writes one file per size of the mix into a document root for the web server
+def make_docroot(directory, mix):
+    for size, _ in mix:
+        with open(os.path.join(directory, f"file-{size}.bin"), 'wb') as file:
+            file.write(os.urandom(size))
+
+
+def start_webserver(docroot, port, workers):
+    process = subprocess.Popen([sys.executable, os.path.join(HERE, 'webserver.py'), '--host', HOST,
+                                '--port', str(port), '--workers', str(workers)], cwd=docroot,
+                               stdout=subprocess.DEVNULL)
+    wait_for_port(port, process)
+    return process
+
+
+# Runs proxyserver.py on `port`, with its cache directory inside `work_dir`
+def start_proxy(work_dir, port):
+    code = (f"import sys; sys.path.insert(0, {HERE!r}); import proxyserver; "
+            f"proxyserver.config['HOST_NAME'] = {HOST!r}; proxyserver.config['PORT'] = {port}; "
+            f"proxyserver.ProxyServer(proxyserver.config).start()")
+    process = subprocess.Popen([sys.executable, '-c', code], cwd=work_dir, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    wait_for_port(port, process)
+    return process
+
+
+def stop_process(process):
+    process.terminate()
+    try:
+        process.wait(5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+# Stand-in for the internet behind the proxy: answers GET .../<size>?anything with <size> bytes,
+# as an HTTP/1.0 server that closes every connection, like the origins the proxy talks to
+class OriginHandler(BaseHTTPRequestHandler):
+    payloads = {}
+
+    def do_GET(self):
+        try:
+            size = int(self.path.rsplit('/', 1)[-1].split('?')[0])
+        except ValueError:
+            self.send_error(404)
+            return
+        payload = self.payloads.get(size)
+        if payload is None:
+            payload = self.payloads[size] = os.urandom(size)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_origin(port):
+    ThreadingHTTPServer((HOST, port), OriginHandler).serve_forever()
+
+
+# Sends one request and reads the whole response. Returns (status, body bytes, reusable connection).
+async def exchange(reader, writer, request, keep_alive):
+    writer.write(request)
+    await writer.drain()
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('iso-8859-1').split('\r\n')
+    version, status = lines[0].split()[:2]
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    if 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+    else:
+        body = await reader.read()  # Delimited by the server closing the connection
+    reusable = keep_alive and version == 'HTTP/1.1' and 'close' not in headers.get('connection', '').lower() \
+        and 'content-length' in headers
+    return int(status), len(body), reusable
+
+
+# One simulated client: takes the next path from the shared queue and requests it until the queue
+# runs out, over one persistent connection or a new connection per request
+async def client_loop(port, queue, keep_alive, result):
+    reader = writer = None
+    while queue:
+        path = queue.pop()
+        request = f"GET {path} HTTP/1.1\r\nHost: {HOST}:{port}\r\n" \
+                  f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode()
+        start = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(HOST, port)
+            status, size, reusable = await asyncio.wait_for(exchange(reader, writer, request, keep_alive),
+                                                            REQUEST_TIMEOUT)
+        except (OSError, EOFError, ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+            result['errors'][type(e).__name__] = result['errors'].get(type(e).__name__, 0) + 1
+            status, reusable = None, False
+        else:
+            if 200 <= status < 300:
+                result['latencies'].append(time.perf_counter() - start)
+                result['bytes'] += size
+            else:
+                result['errors'][str(status)] = result['errors'].get(str(status), 0) + 1
+        if not reusable and writer is not None:
+            writer.close()
+            reader = writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def run_clients(port, paths, keep_alive, concurrency):
+    result = {'latencies': [], 'bytes': 0, 'errors': {}}
+    queue = paths[::-1]
+    await asyncio.gather(*(client_loop(port, queue, keep_alive, result) for _ in range(concurrency)))
+    return result
+
+
+# Entry point of a load process
+def load_process(port, paths, keep_alive, concurrency):
+    return asyncio.run(run_clients(port, paths, keep_alive, concurrency))
+
+
+# Requests every path once, from `concurrency` clients spread over `processes` processes, and
+# returns the merged results with the wall time they took
+def generate_load(port, paths, keep_alive, concurrency, processes):
+    processes = max(1, min(processes, concurrency))
+    with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn')) as pool:
+        list(pool.map(int, range(processes)))  # Starts the processes before the clock does
+        start = time.perf_counter()
+        futures = [pool.submit(load_process, port, paths[i::processes], keep_alive,
+                               concurrency // processes + (i < concurrency % processes))
+                   for i in range(processes)]
+        results = [future.result() for future in futures]
+        seconds = time.perf_counter() - start
+    merged = {'latencies': [], 'bytes': 0, 'errors': {}, 'seconds': seconds}
+    for result in results:
+        merged['latencies'] += result['latencies']
+        merged['bytes'] += result['bytes']
+        for error, count in result['errors'].items():
+            merged['errors'][error] = merged['errors'].get(error, 0) + count
+    return merged
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else None
+
+
+# Summarizes a run as throughput and latency percentiles in milliseconds
+def summarize(name, result):
+    ordered = sorted(result['latencies'])
+    milliseconds = lambda value: round(value * 1000, 3) if value is not None else None
+    return {
+        'run': name,
+        'requests': len(ordered),
+        'errors': result['errors'],
+        'seconds': round(result['seconds'], 3),
+        'requests_per_sec': round(len(ordered) / result['seconds'], 1),
+        'mib_per_sec': round(result['bytes'] / result['seconds'] / 2 ** 20, 2),
+        'p50_ms': milliseconds(percentile(ordered, 0.50)),
+        'p95_ms': milliseconds(percentile(ordered, 0.95)),
+        'p99_ms': milliseconds(percentile(ordered, 0.99)),
+        'max_ms': milliseconds(ordered[-1] if ordered else None),
+    }
+
+
+def print_summary(summary):
+    errors = ', '.join(f"{count} {error}" for error, count in summary['errors'].items()) or 'none'
+    print(f"{summary['run']}: {summary['requests']} requests in {summary['seconds']}s, "
+          f"{summary['requests_per_sec']} req/s, {summary['mib_per_sec']} MiB/s, errors: {errors}")
+    print(f"\tlatency ms  p50 {summary['p50_ms']}  p95 {summary['p95_ms']}  p99 {summary['p99_ms']}  "
+          f"max {summary['max_ms']}")
+
+
+# File sizes for `requests` requests, drawn from the mix with a fixed seed so runs are comparable
+def draw_sizes(mix, requests):
+    return random.Random(0).choices([size for size, _ in mix], [weight for _, weight in mix], k=requests)
+
+
+# Runs webserver.py on a generated document root and loads it with the mix
+def benchmark_webserver(args, mix, work_dir):
+    make_docroot(work_dir, mix)
+    port = free_port()
+    server = start_webserver(work_dir, port, args.workers)
+    try:
+        paths = [f"/file-{size}.bin" for size in draw_sizes(mix, args.requests)]
+        result = generate_load(port, paths, args.keep_alive, args.concurrency, args.processes)
+    finally:
+        stop_process(server)
+    return [summarize(f"webserver, keep-alive {'on' if args.keep_alive else 'off'}", result)]
+
+
+# Runs proxyserver.py in front of a stand-in origin. The miss run requests a new URL every time,
+# so every request is fetched from the origin; the hit run requests URLs that were cached beforehand.
+def benchmark_proxy(args, mix, work_dir):
+    origin_port, proxy_port = free_port(), free_port()
+    origin = multiprocessing.get_context('spawn').Process(target=run_origin, args=(origin_port,), daemon=True)
+    origin.start()
+    proxy = None
+    try:
+        wait_for_port(origin_port)
+        proxy = start_proxy(work_dir, proxy_port)
+        sizes = draw_sizes(mix, args.requests)
+        url = f"/http://{HOST}:{origin_port}"
+        miss_paths = [f"{url}/{size}?miss={i}" for i, size in enumerate(sizes)]
+        miss = generate_load(proxy_port, miss_paths, False, args.concurrency, args.processes)
+        generate_load(proxy_port, [f"{url}/{size}?hit" for size, _ in mix], False, 1, 1)  # Warms the cache
+        hit = generate_load(proxy_port, [f"{url}/{size}?hit" for size in sizes], False, args.concurrency,
+                            args.processes)
+    finally:
+        if proxy is not None:
+            stop_process(proxy)
+        origin.terminate()
+    return [summarize("proxy, cache miss", miss), summarize("proxy, cache hit", hit)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the throughput and latency of webserver.py or "
+                                                 "proxyserver.py on loopback")
+    parser.add_argument('target', choices=['webserver', 'proxy'], help="server to benchmark")
+    parser.add_argument('--requests', type=int, default=10000, help="requests per run (default: 10000)")
+    parser.add_argument('--concurrency', type=int, default=50, help="simultaneous clients (default: 50)")
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help=f"file sizes requested and their weights, as SIZE:WEIGHT,... (default: {DEFAULT_MIX})")
+    parser.add_argument('--no-keep-alive', dest='keep_alive', action='store_false',
+                        help="open a new connection per request (the proxy always closes them)")
+    parser.add_argument('--workers', type=int, default=1, help="webserver.py worker processes (default: 1)")
+    parser.add_argument('--processes', type=int, default=1, help="load generating processes (default: 1)")
+    parser.add_argument('--output', help="also write the results to this JSON file")
+    args = parser.parse_args()
+    try:
+        mix = parse_mix(args.mix)
+    except (ValueError, KeyError):
+        parser.error(f"invalid --mix {args.mix}")
+
+    with tempfile.TemporaryDirectory(prefix='loadtest-') as work_dir:
+        if args.target == 'webserver':
+            summaries = benchmark_webserver(args, mix, work_dir)
+        else:
+            summaries = benchmark_proxy(args, mix, work_dir)
+    for summary in summaries:
+        print_summary(summary)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(summaries, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+CSE 310
+Taein Um
+112348159
+"""
+
+import threading
+from bisect import bisect_left
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'  # Prometheus text exposition format
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+# A value that only goes up, per combination of label values. Updates are thread-safe.
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {} if labels else {(): 0}  # Unlabelled metrics are exported from the start
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    # Copy of the value of every series
+    def collect(self):
+        with self.lock:
+            return dict(self.values)
+
+    # Adds a series value, e.g. from another process, into collected values
+    def add(self, values, key, value):
+        values[key] = values.get(key, 0) + value
+
+    # (sample name, formatted labels, value) of every collected series
+    def samples(self, values):
+        return [(self.name, format_labels(self.labels, key), value) for key, value in values.items()]
+
+
+# A value that goes up and down, like the number of open connections
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+    def set(self, value, labels=()):
+        with self.lock:
+            self.values[labels] = value
+
+
+# Counts of observations, such as request latencies in seconds, per bucket upper bound
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.values = {}  # label values -> [count per bucket and +Inf, sum of observations]
+        if not labels:
+            self.values[()] = [[0] * (len(self.buckets) + 1), 0.0]
+        self.lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        with self.lock:
+            series = self.values.get(labels)
+            if series is None:
+                series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def collect(self):
+        with self.lock:
+            return {key: [list(counts), total] for key, (counts, total) in self.values.items()}
+
+    def add(self, values, key, value):
+        series = values.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0])
+        series[0] = [count + other for count, other in zip(series[0], value[0])]
+        series[1] += value[1]
+
+    def samples(self, values):
+        samples = []
+        for key, (counts, total) in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                samples.append((f"{self.name}_bucket", format_labels(self.labels, key, [('le', le)]), cumulative))
+            samples.append((f"{self.name}_sum", format_labels(self.labels, key), total))
+            samples.append((f"{self.name}_count", format_labels(self.labels, key), cumulative))
+        return samples
+
+
+# The metrics of a server, rendered for a /metrics endpoint
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    # JSON-serializable values of every metric, to be combined with the registries of other processes
+    def snapshot(self):
+        return {metric.name: [[list(key), value] for key, value in metric.collect().items()]
+                for metric in self.metrics}
+
+    # Sums snapshots of this registry into one, keeping only the metrics of the given kinds
+    def merge(self, snapshots, kinds=('counter', 'gauge', 'histogram')):
+        merged = {}
+        for metric in self.metrics:
+            if metric.kind in kinds:
+                values = {}
+                for snapshot in snapshots:
+                    for key, value in snapshot.get(metric.name, ()):
+                        metric.add(values, tuple(key), value)
+                merged[metric.name] = [[list(key), value] for key, value in values.items()]
+        return merged
+
+    # Renders the metrics of this process or, given snapshots of the processes sharing the work, their sum
+    def render(self, snapshots=None):
+        lines = []
+        for metric in self.metrics:
+            values = metric.collect() if snapshots is None else {}
+            for snapshot in snapshots or ():
+                for key, value in snapshot.get(metric.name, ()):
+                    metric.add(values, tuple(key), value)
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines += [f"{name}{labels} {value}" for name, labels, value in metric.samples(values)]
+        return "\n".join(lines) + "\n"
@@ -10,6 +10,9 @@ import signal
 import os
 import hashlib
 import logging
+import time
+
+from metrics import CONTENT_TYPE, Registry
 
 # Set up logging for debugging and monitoring
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -23,6 +26,29 @@ config = {
     'CACHE_DIR': 'cache'  # Directory to store cached content
 }
 
+# Metrics exported on /metrics
+metrics = Registry()
+requests_total = metrics.counter('proxy_requests_total', "Requests answered, by cache result and response status",
+                                 ('cache', 'status'))
+request_seconds = metrics.histogram('proxy_request_duration_seconds',
+                                    "Seconds from a request being received to its response being sent", ('cache',))
+upstream_seconds = metrics.histogram('proxy_upstream_fetch_duration_seconds',
+                                     "Seconds spent fetching responses from origin servers")
+errors_total = metrics.counter('proxy_errors_total', "Requests that failed with an error")
+received_bytes = metrics.counter('proxy_received_bytes_total', "Bytes received from clients")
+sent_bytes = metrics.counter('proxy_sent_bytes_total', "Bytes sent to clients")
+upstream_bytes = metrics.counter('proxy_upstream_received_bytes_total', "Bytes received from origin servers")
+cache_hits = metrics.counter('proxy_cache_hits_total', "Requests served from the cache")
+cache_misses = metrics.counter('proxy_cache_misses_total', "Requests fetched from the origin server")
+open_connections = metrics.gauge('proxy_connections', "Client connections being served")
+
+
+# Status code of a raw HTTP response, for the metrics
+def response_status(data):
+    parts = data.split(b' ', 2)
+    return parts[1].decode('ascii') if len(parts) > 1 and parts[1].isdigit() else 'unknown'
+
+
 # Ensure cache directory exists
 if not os.path.isdir(config['CACHE_DIR']):
     os.makedirs(config['CACHE_DIR'])
@@ -41,8 +67,12 @@ class ProxyServer:
 
     def proxy_thread(self, conn, client_address):
         # Thread to handle each client request
+        open_connections.inc()
         try:
-            request_line = conn.recv(config['MAX_REQUEST_LEN']).decode('utf-8')
+            request = conn.recv(config['MAX_REQUEST_LEN'])
+            start = time.perf_counter()
+            received_bytes.inc(len(request))
+            request_line = request.decode('utf-8')
             if not request_line:  # Ignore empty requests
                 return
             # Extract and process URL from client request
@@ -50,6 +80,13 @@ class ProxyServer:
             url = first_line.split(' ')[1]
             actual_url = url[1:]  # Remove leading slash
 
+            # Serve the proxy's own metrics
+            if url == '/metrics':
+                content = metrics.render().encode()
+                conn.sendall(f"HTTP/1.0 200 OK\r\nContent-Type: {CONTENT_TYPE}\r\n"
+                             f"Content-Length: {len(content)}\r\n\r\n".encode() + content)
+                return
+
             # Ignore favicon.ico requests
             if "favicon.ico" in actual_url:
                 conn.close()
@@ -70,19 +107,30 @@ class ProxyServer:
 
             # Serve content from cache or fetch from web
             if os.path.isfile(cache_filepath):
-                logging.info("Cache hit for {0}".format(actual_url))
+                logging.debug("Cache hit for {0}".format(actual_url))
+                cache_hits.inc()
                 with open(cache_filepath, 'rb') as f:
-                    conn.sendall(f.read())
+                    response = f.read()
+                conn.sendall(response)
+                sent_bytes.inc(len(response))
+                status, cache = response_status(response), 'hit'
             else:
-                logging.info("Cache miss for {0}. Fetching from web.".format(actual_url))
-                self.fetch_from_web(conn, webserver, port, path, cache_filepath)
+                logging.debug("Cache miss for {0}. Fetching from web.".format(actual_url))
+                cache_misses.inc()
+                status, cache = self.fetch_from_web(conn, webserver, port, path, cache_filepath), 'miss'
+            requests_total.inc(labels=(cache, status))
+            request_seconds.observe(time.perf_counter() - start, labels=(cache,))
         except Exception as e:
+            errors_total.inc()
             logging.error("An error occurred: {0}".format(e))
         finally:
             conn.close()
+            open_connections.dec()
 
     def fetch_from_web(self, conn, webserver, port, path, cache_filepath):
-        # Fetch content from the web and cache it
+        # Fetch content from the web and cache it, returning the status code of the response
+        start = time.perf_counter()
+        status = 'unknown'
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
             s.settimeout(config['CONNECTION_TIMEOUT'])
             s.connect((webserver, port))
@@ -92,10 +140,16 @@ class ProxyServer:
                 while True:
                     data = s.recv(config['MAX_REQUEST_LEN'])
                     if len(data) > 0:
-                        conn.send(data)
+                        if status == 'unknown':
+                            status = response_status(data)
+                        upstream_bytes.inc(len(data))
+                        conn.sendall(data)
+                        sent_bytes.inc(len(data))
                         cache_file.write(data)
                     else:
                         break
+        upstream_seconds.observe(time.perf_counter() - start)
+        return status
 
     def shutdown(self, signum, frame):
         # Shutdown the proxy server
@@ -4,67 +4,929 @@ Taein Um
 112348159
 """
 
+import argparse
 import socket
 import os
+import signal
+import sys
+import traceback
+import gzip
+import json
+import shutil
+import contextlib
 import mimetypes
+import selectors
+import stat
+import tempfile
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from email.utils import formatdate, parsedate_to_datetime
+
+from metrics import CONTENT_TYPE, Registry
+
+RECV_SIZE = 65536  # Bytes read from a client socket per recv call
+MAX_HEADER_BYTES = 65536  # Largest request line + headers accepted from a client
+MAX_BODY_BYTES = 65536  # Largest request body accepted; larger ones are refused before they are buffered
+KEEPALIVE_TIMEOUT = 15.0  # Seconds an idle connection is kept open
+MAX_KEEPALIVE_REQUESTS = 1000  # Requests served on one connection before it is closed
+MAX_PENDING_OUTPUT = 1 << 20  # Queued response bytes after which pipelined requests wait
+STOP_TIMEOUT = 30.0  # Seconds a stopping server waits for the responses in progress
+RESTART_DELAY = 1.0  # Seconds before restarting a worker that crashed right after it started
+MASTER_SIGNALS = (signal.SIGINT, signal.SIGTERM, signal.SIGALRM)  # Handled by the master of --workers
+SENDFILE_CHUNK = 1 << 24  # Most bytes handed to one sendfile call
+MSG_MORE = getattr(socket, 'MSG_MORE', 0)  # Lets the kernel merge headers with the body that follows
+METRICS_SNAPSHOT_INTERVAL = 1.0  # Seconds between the metric snapshots a worker shares with its siblings
+CACHE_MAX_BYTES = 64 << 20  # Memory used by the static file cache before least recently used files are evicted
+CACHE_MAX_FILE_SIZE = 256 << 10  # Larger files are streamed from disk; only their metadata is cached
+CACHE_CHECK_INTERVAL = 1.0  # Seconds a cached file is served before it is stat-ed again for changes
+CACHE_ENTRY_OVERHEAD = 256  # Bytes charged per cache entry on top of its content and headers
+MAX_RANGES = 16  # Requests for more byte ranges than this get the whole file
+GZIP_TYPES = ('text/', 'application/javascript', 'application/json', 'application/xml', 'image/svg+xml')
+GZIP_MIN_SIZE = 256  # Smaller files are not worth compressing
+GZIP_MAX_DISK_SIZE = 8 << 20  # Larger files are only sent compressed if a .gz was precompressed next to them
+GZIP_LEVEL = 6  # Cached files are compressed on the event loop, so speed matters as much as the ratio
+METHODS = ('GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'OPTIONS', 'PATCH', 'CONNECT', 'TRACE')  # Method label values
+
+# Metrics of this server process, exported on /metrics
+metrics = Registry()
+requests_total = metrics.counter('webserver_requests_total', "HTTP requests answered", ('method', 'status'))
+request_seconds = metrics.histogram('webserver_request_duration_seconds',
+                                    "Seconds from a request being received to its whole response being sent")
+received_bytes = metrics.counter('webserver_received_bytes_total', "Bytes received from clients")
+sent_bytes = metrics.counter('webserver_sent_bytes_total', "Bytes sent to clients")
+open_connections = metrics.gauge('webserver_connections', "Open client connections")
+cache_hits = metrics.counter('webserver_file_cache_hits_total', "File lookups answered by the static file cache")
+cache_misses = metrics.counter('webserver_file_cache_misses_total', "File lookups that had to load the file")
+cache_evictions = metrics.counter('webserver_file_cache_evictions_total',
+                                  "Files evicted from the static file cache to stay within its size")
+cache_bytes = metrics.gauge('webserver_file_cache_bytes', "Memory charged to the static file cache")
+
+
+class BadRequest(Exception):
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+
+# A parsed HTTP request
+class HttpRequest:
+    def __init__(self, method, target, version, headers, body=b''):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers  # Header names are lower-cased
+        self.body = body
+
+    # HTTP/1.1 connections persist unless the client asks to close; HTTP/1.0 ones only on request
+    def wants_keep_alive(self):
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return 'keep-alive' in connection
+        return 'close' not in connection
+
+
+# A response body streamed from `count` bytes of an open file starting at `offset`. Multipart
+# bodies send several ranges of one file, and only the last of them closes it.
+class FileBody:
+    def __init__(self, file, offset, count, closes_file=True):
+        self.file = file
+        self.offset = offset
+        self.remaining = count
+        self.closes_file = closes_file
+
+
+# An HTTP response; the server adds the Connection header when it sends it
+class HttpResponse:
+    def __init__(self, status, headers, body=b''):
+        self.status = status
+        self.headers = headers  # List of (name, value)
+        self.body = body  # bytes, a FileBody sent without loading the file into memory, or a list of both
+
+    def head(self, keep_alive):
+        lines = [f"HTTP/1.1 {self.status}"] + [f"{name}: {value}" for name, value in self.headers]
+        lines.append("Connection: keep-alive" if keep_alive else "Connection: close")
+        return ("\r\n".join(lines) + "\r\n\r\n").encode()
+
+
+# A response whose head is built once for both Connection values, so it can be sent again and again
+class PrebuiltResponse(HttpResponse):
+    def __init__(self, status, headers, body):
+        super().__init__(status, headers, body)
+        self.heads = {keep_alive: HttpResponse.head(self, keep_alive) for keep_alive in (True, False)}
+
+    def head(self, keep_alive):
+        return self.heads[keep_alive]
+
+
+# What the cache knows about a file: its Content-Type, validators and, for small files, the whole
+# response. The 304 Not Modified response of the file is prebuilt too.
+class CachedFile:
+    __slots__ = ('content_type', 'content', 'mtime_ns', 'size', 'etag', 'last_modified', 'compressible', 'gzip',
+                 'headers', 'response', 'not_modified', 'checked_at', 'cost')
+
+    def __init__(self, content_type, content, st, checked_at):
+        self.content_type = content_type
+        self.content = content  # None for files streamed from disk
+        self.mtime_ns = st.st_mtime_ns
+        self.size = st.st_size
+        self.etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+        self.last_modified = formatdate(st.st_mtime, usegmt=True)
+        self.compressible = content_type.startswith(GZIP_TYPES) and st.st_size >= GZIP_MIN_SIZE
+        self.gzip = None  # GzipVariant once produced, a Future while it is, False if the file is sent uncompressed
+        validators = [("ETag", self.etag), ("Last-Modified", self.last_modified)]
+        self.headers = [("Content-Type", content_type), ("Accept-Ranges", "bytes")] + validators
+        if self.compressible:
+            self.headers.append(("Vary", "Accept-Encoding"))
+        self.response = None
+        if content is not None:
+            self.response = PrebuiltResponse("200 OK", [("Content-Length", len(content))] + self.headers, content)
+        self.not_modified = PrebuiltResponse("304 Not Modified", self.headers[2:], b'')  # Validators and Vary
+        self.checked_at = checked_at
+        self.cost = CACHE_ENTRY_OVERHEAD + len(self.not_modified.heads[True])
+        if self.response is not None:
+            self.cost += len(content) + len(self.response.heads[True])
+
+
+# The gzip-encoded version of a file, kept in memory for cached files and in a .gz file next to
+# larger ones. It has its own ETag, since it is a different representation of the file.
+class GzipVariant:
+    __slots__ = ('path', 'size', 'mtime_ns', 'etag', 'headers', 'response', 'not_modified', 'cost')
+
+    def __init__(self, entry, content=None, path=None, size=None):
+        self.path = path
+        self.size = len(content) if content is not None else size
+        self.mtime_ns = entry.mtime_ns
+        self.etag = entry.etag[:-1] + '-gzip"'
+        validators = [("ETag", self.etag), ("Last-Modified", entry.last_modified)]
+        self.headers = [("Content-Type", entry.content_type), ("Content-Encoding", "gzip"),
+                        ("Vary", "Accept-Encoding")] + validators
+        self.response = None
+        if content is not None:
+            self.response = PrebuiltResponse("200 OK", [("Content-Length", self.size)] + self.headers, content)
+        self.not_modified = PrebuiltResponse("304 Not Modified", [("Vary", "Accept-Encoding")] + validators, b'')
+        self.cost = len(self.not_modified.heads[True])
+        if self.response is not None:
+            self.cost += self.size + len(self.response.heads[True])
+
+
+# Function to compress a file once. Cached files are compressed in memory; larger ones into a .gz
+# next to them, which carries the mtime of the file so it is reused until the file changes (a .gz
+# precompressed with `gzip -k` qualifies too). Returns None when compression does not pay off.
+# Files compressed to disk are done on a thread, since zlib releases the GIL while it works.
+def make_gzip_variant(path, entry):
+    if entry.content is not None:
+        content = gzip.compress(entry.content, GZIP_LEVEL, mtime=0)
+        return GzipVariant(entry, content=content) if len(content) < entry.size else None
+
+    gz_path = path + '.gz'
+    try:
+        st = os.stat(gz_path)
+    except OSError:
+        st = None
+    if st is None or st.st_mtime_ns != entry.mtime_ns:
+        if entry.size > GZIP_MAX_DISK_SIZE:
+            return None
+        temp_path = f"{gz_path}.{os.getpid()}.tmp"
+        try:
+            with open(path, 'rb') as source, open(temp_path, 'wb') as raw, \
+                    gzip.GzipFile('', 'wb', GZIP_LEVEL, raw, mtime=0) as target:  # No temp name in the header
+                shutil.copyfileobj(source, target)
+            os.utime(temp_path, ns=(entry.mtime_ns, entry.mtime_ns))
+            os.replace(temp_path, gz_path)  # Atomic, so a half-written variant is never served
+            st = os.stat(gz_path)
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.remove(temp_path)
+            return None  # e.g. a read-only directory
+    return GzipVariant(entry, path=gz_path, size=st.st_size) if st.st_size < entry.size else None
+
+
+# Cache of the static files served, bounded by max_bytes with least recently used eviction.
+# Entries are trusted for check_interval seconds, so hot files are served without any file
+# system calls; after that the file is stat-ed and reloaded if its mtime or size changed.
+class FileCache:
+    def __init__(self, max_bytes=CACHE_MAX_BYTES, max_file_size=CACHE_MAX_FILE_SIZE,
+                 check_interval=CACHE_CHECK_INTERVAL, root='.'):
+        self.root = os.path.realpath(root)  # Only files inside this directory are served
+        self.compressor = None  # Thread compressing disk variants, started on first use
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.check_interval = check_interval
+        self.entries = OrderedDict()  # path -> CachedFile, least recently used first
+        self.total_bytes = 0
+
+    # Returns the CachedFile of a regular file inside the root, or None if there is no such file
+    def lookup(self, path):
+        now = time.monotonic()
+        entry = self.entries.get(path)
+        if entry is not None:
+            if now - entry.checked_at < self.check_interval:
+                self.entries.move_to_end(path)
+                cache_hits.inc()
+                return entry
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+            if st is not None and stat.S_ISREG(st.st_mode) and (st.st_mtime_ns, st.st_size) == (entry.mtime_ns,
+                                                                                               entry.size):
+                entry.checked_at = now
+                self.entries.move_to_end(path)
+                cache_hits.inc()
+                return entry
+            self.remove(path)
+        cache_misses.inc()
+        return self.load(path, now)
+
+    def load(self, path, now):
+        # Targets such as /../secret or //etc/passwd, and symlinks, must not leave the root
+        if os.path.commonpath([self.root, os.path.realpath(path)]) != self.root:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                st = os.fstat(f.fileno())
+                if not stat.S_ISREG(st.st_mode):
+                    return None
+                content = f.read() if st.st_size <= self.max_file_size else None
+        except OSError:
+            return None
+        mime_type, _ = mimetypes.guess_type(path)  # Dynamically sets the Content-Type based on the file
+        mime_type = mime_type or 'application/octet-stream'  # Default MIME type for binary files
+        entry = CachedFile(mime_type, content, st, now)
+        self.entries[path] = entry
+        self.total_bytes += entry.cost
+        self.evict()
+        return entry
+
+    # Returns the gzip variant of a compressible file, producing it the first time it is asked for.
+    # Cached files are compressed right away; larger files are compressed on the compressor thread
+    # and sent uncompressed until it is done, so the event loop never waits for them.
+    def gzip_variant(self, path, entry):
+        if entry.gzip is None:
+            if entry.content is not None:
+                self.add_variant(path, entry, make_gzip_variant(path, entry))
+            else:
+                if self.compressor is None:
+                    self.compressor = ThreadPoolExecutor(1, thread_name_prefix='gzip')
+                entry.gzip = self.compressor.submit(make_gzip_variant, path, entry)
+        if isinstance(entry.gzip, Future) and entry.gzip.done():
+            future = entry.gzip
+            self.add_variant(path, entry, future.result() if future.exception() is None else None)
+        return entry.gzip if isinstance(entry.gzip, GzipVariant) else None
+
+    def add_variant(self, path, entry, variant):
+        entry.gzip = variant or False
+        if variant and self.entries.get(path) is entry:
+            entry.cost += variant.cost
+            self.total_bytes += variant.cost
+            self.evict()
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes:
+            self.remove(next(iter(self.entries)))
+            cache_evictions.inc()
+        cache_bytes.set(self.total_bytes)
+
+    def remove(self, path):
+        self.total_bytes -= self.entries.pop(path).cost
+        cache_bytes.set(self.total_bytes)
+
+
+file_cache = FileCache()
+
+# Directory where the workers of --workers share their metric snapshots: one <pid>.json per worker,
+# and retired.json with the counters of the workers that exited and their pids; None in one process
+metrics_dir = None
+RETIRED_METRICS = 'retired.json'
+
+
+# Function to read a snapshot file, or `default` if it is missing or being replaced
+def load_json(path, default=None):
+    try:
+        with open(path) as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        return default
+
+
+# Function to replace a snapshot file atomically, so readers never see it half written
+def save_json(path, value):
+    with open(path + '.tmp', 'w') as json_file:
+        json.dump(value, json_file)
+    os.replace(path + '.tmp', path)
+
+
+# Function to publish the metrics of this worker to its siblings
+def save_metrics_snapshot():
+    save_json(os.path.join(metrics_dir, f"{os.getpid()}.json"), metrics.snapshot())
+
+
+# Function to collect the metrics of every worker for a scrape. All of them are read from the
+# snapshot files, which only grow, so totals never go back between scrapes answered by different
+# workers. Worker files are read before retired.json, and skipped when it already holds them.
+def worker_metrics_snapshots():
+    save_metrics_snapshot()
+    snapshots = {}
+    for name in os.listdir(metrics_dir):
+        if name.endswith('.json') and name != RETIRED_METRICS:
+            snapshot = load_json(os.path.join(metrics_dir, name))
+            if snapshot is not None:
+                snapshots[name[:-len('.json')]] = snapshot
+    retired = load_json(os.path.join(metrics_dir, RETIRED_METRICS))
+    if retired is None:
+        return list(snapshots.values())
+    for pid in retired['pids']:
+        snapshots.pop(str(pid), None)
+    return list(snapshots.values()) + [retired['metrics']]
+
+
+# Function for the master to fold the counters and histograms of an exited worker into
+# retired.json; its gauges, like open connections, are dropped
+def retire_metrics_snapshot(pid):
+    path = os.path.join(metrics_dir, f"{pid}.json")
+    retired_path = os.path.join(metrics_dir, RETIRED_METRICS)
+    retired = load_json(retired_path, {'pids': [], 'metrics': {}})
+    snapshots = [retired['metrics'], load_json(path, {})]
+    # Only pids whose files could still be read need to be remembered
+    pids = [old for old in retired['pids'] if os.path.exists(os.path.join(metrics_dir, f"{old}.json"))]
+    save_json(retired_path, {'pids': pids + [pid],
+                             'metrics': metrics.merge(snapshots, kinds=('counter', 'histogram'))})
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+
+
+# Function to parse one request from the start of a buffer. Returns (request, bytes consumed),
+# or (None, 0) while the request is still incomplete, so data can be fed in as it arrives.
+def parse_request(buffer):
+    head_end = buffer.find(b'\r\n\r\n')
+    if head_end == -1:
+        if len(buffer) > MAX_HEADER_BYTES:
+            raise BadRequest("431 Request Header Fields Too Large")
+        return None, 0
+    if head_end > MAX_HEADER_BYTES:
+        raise BadRequest("431 Request Header Fields Too Large")
+
+    lines = bytes(buffer[:head_end]).decode('iso-8859-1').split('\r\n')
+    parts = lines[0].split()
+    if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+        raise BadRequest("400 Bad Request")
+    method, target, version = parts
+    headers = {}
+    for line in lines[1:]:
+        name, separator, value = line.partition(':')
+        if not separator:
+            raise BadRequest("400 Bad Request")
+        headers[name.strip().lower()] = value.strip()
+
+    # Request bodies are only delimited by Content-Length
+    if 'transfer-encoding' in headers:
+        raise BadRequest("501 Not Implemented")
+    content_length = headers.get('content-length', '0')
+    if not (content_length.isascii() and content_length.isdigit()):
+        raise BadRequest("400 Bad Request")  # Also refuses signs, so the length cannot be negative
+    body_length = int(content_length)
+    if body_length > MAX_BODY_BYTES:
+        raise BadRequest("413 Content Too Large")
+    request_end = head_end + 4 + body_length
+    if len(buffer) < request_end:
+        return None, 0
+    return HttpRequest(method, target, version, headers, bytes(buffer[head_end + 4:request_end])), request_end
 
 
 # Function to generate an HTTP response
-def http_response(header, content_type, content):
+def http_response(status, content_type, content):
     # Constructs an HTTP response with appropriate headers and content
-    return f"{header}\r\nContent-Length: {len(content)}\r\nContent-Type: {content_type}\r\n\r\n".encode() + content
+    return HttpResponse(status, [("Content-Length", len(content)), ("Content-Type", content_type)], content)
+
+
+# Function to check if a client accepts gzip-encoded responses, honoring q=0 exclusions
+def accepts_gzip(request):
+    qualities = {}
+    for item in request.headers.get('accept-encoding', '').split(','):
+        coding, _, parameters = item.partition(';')
+        name, _, value = parameters.partition('=')
+        try:
+            quality = float(value) if name.strip().lower() == 'q' else 1.0
+        except ValueError:
+            quality = 0.0
+        qualities[coding.strip().lower()] = quality
+    return qualities.get('gzip', qualities.get('x-gzip', qualities.get('*', 0.0))) > 0
+
+
+# Function to check the conditional headers of a request against a file or its gzip variant.
+# If-None-Match takes precedence over If-Modified-Since, and ETags are compared weakly.
+def is_not_modified(request, entry):
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        if if_none_match.strip() == '*':
+            return True
+        return entry.etag in (tag.strip().removeprefix('W/') for tag in if_none_match.split(','))
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False  # Invalid dates are ignored
+        return entry.mtime_ns // 1_000_000_000 <= since
+    return False
+
+
+# Function to parse a Range header into a list of inclusive (first, last) byte positions within a
+# file of `size` bytes. Returns None when the header is invalid and must be ignored; an empty list
+# means none of the ranges is satisfiable.
+def parse_range(value, size):
+    unit, _, specs = value.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for spec in specs.split(','):
+        first, dash, last = spec.strip().partition('-')
+        if not dash or not (first or last) or not all(text.isdecimal() for text in (first, last) if text):
+            return None
+        if not first:
+            if int(last) > 0 and size > 0:  # The last `last` bytes
+                ranges.append((max(size - int(last), 0), size - 1))
+            continue
+        if last and int(last) < int(first):
+            return None
+        if int(first) < size:
+            ranges.append((int(first), min(int(last), size - 1) if last else size - 1))
+    return ranges
+
+
+# Function to check that the If-Range header of a request, if any, still names the file
+def if_range_matches(request, entry):
+    if_range = request.headers.get('if-range')
+    return if_range is None or if_range.strip() in (entry.etag, entry.last_modified)
+
+
+# Function to generate a 206 Partial Content response with some ranges of a file, sent from
+# memory when the file is cached and from `file` otherwise. Several ranges form a
+# multipart/byteranges body, each part with its own Content-Range header.
+def range_response(entry, ranges, file):
+    def range_body(first, last, closes_file=True):
+        if file is None:
+            return entry.content[first:last + 1]
+        return FileBody(file, first, last - first + 1, closes_file)
+
+    if len(ranges) == 1:
+        first, last = ranges[0]
+        headers = [("Content-Length", last - first + 1), ("Content-Range", f"bytes {first}-{last}/{entry.size}")]
+        return HttpResponse("206 Partial Content", headers + entry.headers, range_body(first, last))
+
+    boundary = os.urandom(12).hex()
+    body = []
+    for i, (first, last) in enumerate(ranges):
+        body.append(f"\r\n--{boundary}\r\nContent-Type: {entry.content_type}\r\n"
+                    f"Content-Range: bytes {first}-{last}/{entry.size}\r\n\r\n".encode())
+        body.append(range_body(first, last, closes_file=i == len(ranges) - 1))
+    body.append(f"\r\n--{boundary}--\r\n".encode())
+    length = sum(part.remaining if isinstance(part, FileBody) else len(part) for part in body)
+    headers = [("Content-Length", length), ("Content-Type", f"multipart/byteranges; boundary={boundary}")]
+    return HttpResponse("206 Partial Content", headers + entry.headers[1:],
+                        body if file is not None else b''.join(body))
 
 
 # Function to generate a 404 Not Found response
 def file_not_found_response():
     # Returns a 404 error page as part of the HTTP response
     content = "<html><body><h1>404 Not Found</h1></body></html>".encode()
-    return http_response("HTTP/1.0 404 Not Found", "text/html", content)
+    return http_response("404 Not Found", "text/html", content)
+
 
+# Function to generate an error response for a request that could not be served
+def error_response(status):
+    content = f"<html><body><h1>{status}</h1></body></html>".encode()
+    return http_response(status, "text/html", content)
 
-# Function to handle incoming client requests
-def handle_request(client_connection):
-    # Receives and decodes the client's request
-    request = client_connection.recv(1024).decode()
-    print(f"Received request:\n{request}")
 
-    # Parses the request to extract the filename
-    lines = request.splitlines()
-    top_line = lines[0]
-    filename = top_line.split()[1]
+# Function to handle a parsed client request and return the response to send
+def handle_request(request):
+    if request.method not in ('GET', 'HEAD'):
+        return error_response("501 Not Implemented")
+    if request.target == '/metrics':
+        if metrics_dir is not None:
+            return http_response("200 OK", CONTENT_TYPE, metrics.render(worker_metrics_snapshots()).encode())
+        return http_response("200 OK", CONTENT_TYPE, metrics.render().encode())
 
     # Prepares the file path
-    filepath = filename[1:]
+    filepath = request.target[1:]
     if filepath == "":
         filepath = "HelloWorld.html"  # Default file to serve if no specific file is requested
 
-    # Checks if the file exists and determines its MIME type
-    if os.path.isfile(filepath):
-        mime_type, _ = mimetypes.guess_type(filepath)  # Dynamically sets the Content-Type based on the file
-        mime_type = mime_type or 'application/octet-stream'  # Default MIME type for binary files
-        with open(filepath, 'rb') as f:
-            response_content = f.read()
-        response = http_response("HTTP/1.0 200 OK", mime_type, response_content)
+    # Looks the file up in the cache, which knows if it exists and its MIME type
+    entry = file_cache.lookup(filepath)
+    if entry is None:
+        return file_not_found_response()  # Handles the case where the file is not found
+    # Compressible files are sent gzip-encoded to clients that accept it, except for byte ranges
+    if entry.compressible and 'range' not in request.headers and accepts_gzip(request):
+        variant = file_cache.gzip_variant(filepath, entry)
+        if variant is not None:
+            if is_not_modified(request, variant):
+                return variant.not_modified
+            if variant.response is not None:
+                return variant.response
+            try:
+                f = open(variant.path, 'rb')
+            except OSError:
+                pass  # The .gz was removed; the file is sent uncompressed
+            else:
+                return HttpResponse("200 OK", [("Content-Length", variant.size)] + variant.headers,
+                                    FileBody(f, 0, variant.size))
+
+    if is_not_modified(request, entry):
+        return entry.not_modified  # The client's copy is up to date
+
+    # Byte ranges, e.g. to resume a download; an invalid or stale Range header gets the whole file
+    ranges = None
+    if request.method == 'GET' and 'range' in request.headers and if_range_matches(request, entry):
+        ranges = parse_range(request.headers['range'], entry.size)
+        if ranges == []:
+            response = error_response("416 Range Not Satisfiable")
+            response.headers.append(("Content-Range", f"bytes */{entry.size}"))
+            return response
+        if ranges is not None and len(ranges) > MAX_RANGES:
+            ranges = None
+
+    if entry.response is not None:
+        # Small files are served from memory
+        return entry.response if ranges is None else range_response(entry, ranges, None)
+    try:
+        f = open(filepath, 'rb')  # Streamed by the server with sendfile, then closed
+    except OSError:
+        return file_not_found_response()
+    if ranges is not None:
+        return range_response(entry, ranges, f)
+    return HttpResponse("200 OK", [("Content-Length", entry.size)] + entry.headers, FileBody(f, 0, entry.size))
+
+
+# Sends part of a file body on a non-blocking socket and returns the number of bytes sent
+def send_file_part(sock, body):
+    count = min(body.remaining, SENDFILE_CHUNK)
+    if hasattr(os, 'sendfile'):
+        sent = os.sendfile(sock.fileno(), body.file.fileno(), body.offset, count)
     else:
-        response = file_not_found_response()  # Handles the case where the file is not found
+        body.file.seek(body.offset)
+        sent = sock.send(body.file.read(min(count, RECV_SIZE)))
+    if sent == 0:
+        raise ConnectionAbortedError("file truncated while it was being sent")
+    body.offset += sent
+    body.remaining -= sent
+    return sent
 
-    # Sends the constructed HTTP response to the client
-    client_connection.sendall(response)
 
+# State of one client connection: bytes received but not parsed yet, and response parts still to send
+class Connection:
+    def __init__(self, sock):
+        self.sock = sock
+        self.inbuf = bytearray()
+        self.output = deque()  # bytearray and FileBody parts, in sending order
+        self.pending = 0  # Bytes queued in output
+        self.sent = 0  # Bytes sent so far
+        self.responses = deque()  # (end position in the bytes sent, start time) of responses not fully sent
+        self.requests = 0  # Requests answered so far
+        self.close_when_sent = False
+        self.events = selectors.EVENT_READ  # Events the selector watches for
+        self.last_active = time.monotonic()
 
-# Function to start the web server
-def start_server(port):
+
+# Function to create the non-blocking listening socket of a server on `host` ('' for every interface).
+# With reuse_port, every worker process binds its own socket to the port and the kernel spreads
+# connections among them.
+def listen_socket(port, reuse_port=False, host=''):
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind(('', port))
-    server_socket.listen(1)  # Listens for incoming connections
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server_socket.bind((host, port))
+    server_socket.listen(socket.SOMAXCONN)
+    server_socket.setblocking(False)
+    return server_socket
+
+
+# Non-blocking server that multiplexes all client connections on one thread with a selector.
+# Requests are parsed incrementally as data arrives and answered by handle_request, in order,
+# on persistent HTTP/1.1 connections that may pipeline requests.
+class WebServer:
+    def __init__(self, port, handler=handle_request, keepalive_timeout=KEEPALIVE_TIMEOUT,
+                 max_requests=MAX_KEEPALIVE_REQUESTS, server_socket=None, reuse_port=False, host=''):
+        self.handler = handler
+        self.keepalive_timeout = keepalive_timeout
+        self.max_requests = max_requests
+        self.connections = OrderedDict()  # Connection -> None, least recently active first
+        self.stopping = False
+        self.stop_deadline = None
+        self.next_metrics_snapshot = 0.0
+        # A listening socket may be inherited from a master process that forks several servers
+        self.server_socket = server_socket or listen_socket(port, reuse_port, host)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.server_socket, selectors.EVENT_READ)
+
+    # Serves until stop() was called and the connections have been closed
+    def serve_forever(self):
+        while not self.stopping or self.connections:
+            for key, events in self.selector.select(timeout=1.0):
+                if key.data is None:
+                    self.accept_connections()
+                    continue
+                connection = key.data
+                if events & selectors.EVENT_READ:
+                    self.read_requests(connection)
+                if events & selectors.EVENT_WRITE and connection.sock.fileno() != -1:
+                    self.write_responses(connection)
+            if self.stopping:
+                self.finish_connections()
+            self.close_idle_connections()
+            if metrics_dir is not None and time.monotonic() >= self.next_metrics_snapshot:
+                save_metrics_snapshot()
+                self.next_metrics_snapshot = time.monotonic() + METRICS_SNAPSHOT_INTERVAL
+        self.selector.close()
+
+    # Stops accepting connections, e.g. from a signal handler; requests already received are still answered
+    def stop(self):
+        self.stopping = True
+
+    # Closes the listening socket and the connections without a request or response in progress.
+    # The others are closed after their current responses, which say Connection: close, or after STOP_TIMEOUT.
+    def finish_connections(self):
+        if self.stop_deadline is None:
+            self.stop_deadline = time.monotonic() + STOP_TIMEOUT
+            self.selector.unregister(self.server_socket)
+            self.server_socket.close()
+        expired = time.monotonic() > self.stop_deadline
+        for connection in list(self.connections):
+            if expired or not (connection.output or connection.inbuf):
+                self.close_connection(connection)
+
+    # Accepts every connection waiting in the backlog
+    def accept_connections(self):
+        while True:
+            try:
+                client_socket, _ = self.server_socket.accept()
+            except BlockingIOError:
+                return
+            except OSError:
+                return  # e.g. the peer reset the connection before it was accepted, or out of descriptors
+            client_socket.setblocking(False)
+            connection = Connection(client_socket)
+            self.connections[connection] = None
+            self.selector.register(client_socket, selectors.EVENT_READ, connection)
+            open_connections.inc()
+
+    # Marks a connection as active, moving it to the end of the idle order
+    def touch(self, connection):
+        connection.last_active = time.monotonic()
+        self.connections.move_to_end(connection)
+
+    # Closes connections without any progress for keepalive_timeout seconds, including clients that
+    # stopped sending in the middle of a request or stopped reading their responses
+    def close_idle_connections(self):
+        deadline = time.monotonic() - self.keepalive_timeout
+        while self.connections:
+            connection = next(iter(self.connections))
+            if connection.last_active > deadline:
+                break
+            self.close_connection(connection)
+
+    def read_requests(self, connection):
+        try:
+            data = connection.sock.recv(RECV_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.close_connection(connection)
+            return
+        if not data:
+            self.close_connection(connection)  # The client closed the connection
+            return
+        connection.inbuf += data
+        received_bytes.inc(len(data))
+        self.touch(connection)
+        self.process_requests(connection)
+
+    # Answers the complete requests buffered on a connection, in order
+    def process_requests(self, connection):
+        while not connection.close_when_sent:
+            if connection.pending >= MAX_PENDING_OUTPUT:
+                self.send_pending(connection)
+                if connection.output or connection.sock.fileno() == -1:
+                    return  # Continues once the client has read enough of the output
+            try:
+                request, consumed = parse_request(connection.inbuf)
+            except BadRequest as e:
+                self.respond(connection, error_response(e.status), keep_alive=False)
+                break
+            if request is None:
+                break
+            start = time.perf_counter()
+            del connection.inbuf[:consumed]
+            try:
+                response = self.handler(request)
+            except Exception:
+                response = error_response("500 Internal Server Error")
+            connection.requests += 1
+            keep_alive = request.wants_keep_alive() and connection.requests < self.max_requests and not self.stopping
+            self.respond(connection, response, keep_alive, request.method, start)
+        self.send_pending(connection)
+
+    # Queues a response; after a response without keep-alive the connection closes once it is sent.
+    # `method` is None for requests that could not be parsed.
+    def respond(self, connection, response, keep_alive, method=None, start=None):
+        head_only = method == 'HEAD'
+        self.queue_bytes(connection, response.head(keep_alive))
+        for body in response.body if isinstance(response.body, list) else [response.body]:
+            if isinstance(body, FileBody):
+                if head_only or not body.remaining:
+                    if body.closes_file:
+                        body.file.close()
+                else:
+                    connection.output.append(body)
+                    connection.pending += body.remaining
+            elif body and not head_only:
+                self.queue_bytes(connection, body)
+        if not keep_alive:
+            connection.close_when_sent = True
+        requests_total.inc(labels=(method if method in METHODS else 'other' if method else 'invalid',
+                                   response.status[:3]))
+        connection.responses.append((connection.sent + connection.pending, start or time.perf_counter()))
+
+    # Appends bytes to the output, coalescing them with queued bytes
+    def queue_bytes(self, connection, data):
+        if not connection.output or isinstance(connection.output[-1], FileBody):
+            connection.output.append(bytearray())
+        connection.output[-1] += data
+        connection.pending += len(data)
+
+    # Sends as much queued output as the socket accepts, waiting for writability for the rest.
+    # Files go out with sendfile, straight from the page cache. Reading pauses while output is
+    # pending, so a client cannot queue unbounded responses.
+    def send_pending(self, connection):
+        output = connection.output
+        try:
+            while output:
+                part = output[0]
+                if isinstance(part, FileBody):
+                    sent = send_file_part(connection.sock, part)
+                    done = not part.remaining
+                else:
+                    sent = connection.sock.send(part, MSG_MORE if len(output) > 1 else 0)
+                    del part[:sent]
+                    done = not part
+                connection.pending -= sent
+                connection.sent += sent
+                sent_bytes.inc(sent)
+                self.touch(connection)
+                if not done:
+                    break  # The socket buffer is full
+                output.popleft()
+                if isinstance(part, FileBody) and part.closes_file:
+                    part.file.close()
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.close_connection(connection)
+            return
+        responses = connection.responses
+        while responses and responses[0][0] <= connection.sent:
+            request_seconds.observe(time.perf_counter() - responses.popleft()[1])
+        if output:
+            self.watch(connection, selectors.EVENT_WRITE)
+        elif connection.close_when_sent:
+            self.close_connection(connection)
+        else:
+            self.watch(connection, selectors.EVENT_READ)
+
+    def write_responses(self, connection):
+        self.send_pending(connection)
+        if connection.sock.fileno() != -1 and not connection.output and connection.inbuf:
+            self.process_requests(connection)  # Pipelined requests that waited for the output to drain
+
+    def watch(self, connection, events):
+        if connection.events != events:
+            connection.events = events
+            self.selector.modify(connection.sock, events, connection)
+
+    def close_connection(self, connection):
+        del self.connections[connection]
+        self.selector.unregister(connection.sock)
+        connection.sock.close()
+        open_connections.dec()
+        for part in connection.output:
+            if isinstance(part, FileBody):
+                part.file.close()
+
+
+# Function to run a server in a forked worker process; it never returns
+def run_worker(port, server_socket, reuse_port, host):
+    status = 0
+    try:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C reaches the master, which stops the workers
+        server = WebServer(port, server_socket=server_socket, reuse_port=reuse_port, host=host)
+        signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+        server.serve_forever()
+        save_metrics_snapshot()  # Final counts, which the master retires
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+    finally:
+        os._exit(status)  # Never runs the master's code after fork
+
+
+# Function to run `workers` server processes on one port, one per core. The master binds the
+# listening socket and forks workers that share it (or bind their own with reuse_port), restarts
+# workers that crash, and on SIGINT or SIGTERM stops them gracefully, killing them after STOP_TIMEOUT.
+def run_workers(port, workers, reuse_port=False, host=''):
+    global metrics_dir
+    if reuse_port:
+        listen_socket(port, True, host).close()  # Fails now if the port is taken
+        server_socket = None
+    else:
+        server_socket = listen_socket(port, host=host)
+    children = {}  # pid -> start time
+    stopping = False
+
+    # The master's signals stay blocked across fork() and are reset in the child before they are
+    # unblocked, so a child never runs stop() and signals its siblings
+    def spawn():
+        signal.pthread_sigmask(signal.SIG_BLOCK, MASTER_SIGNALS)
+        try:
+            pid = os.fork()
+            if pid == 0:
+                for signum in MASTER_SIGNALS:
+                    signal.signal(signum, signal.SIG_DFL)
+                signal.pthread_sigmask(signal.SIG_UNBLOCK, MASTER_SIGNALS)
+                run_worker(port, server_socket, reuse_port, host)
+        finally:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, MASTER_SIGNALS)
+        children[pid] = time.monotonic()
+        if stopping:
+            os.kill(pid, signal.SIGTERM)  # Stopped while forking
+
+    def stop(signum, frame):
+        nonlocal stopping
+        if not stopping:
+            stopping = True
+            for pid in list(children):
+                os.kill(pid, signal.SIGTERM)
+            signal.alarm(int(STOP_TIMEOUT) + 1)
+
+    def kill(signum, frame):
+        for pid in list(children):
+            os.kill(pid, signal.SIGKILL)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGALRM, kill)
+    metrics_dir = tempfile.mkdtemp(prefix='webserver-metrics-')
+    try:
+        for _ in range(workers):
+            spawn()
+        print(f"Listening on port {port} with {workers} workers...")
+
+        while children:
+            pid, status = os.wait()
+            started = children.pop(pid, None)
+            if started is None:
+                continue
+            retire_metrics_snapshot(pid)
+            if stopping:
+                continue
+            print(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, restarting it",
+                  file=sys.stderr)
+            if time.monotonic() - started < RESTART_DELAY:
+                time.sleep(RESTART_DELAY)  # Avoids a tight loop when workers crash on startup
+            spawn()
+    finally:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+# Function to start the web server
+def start_server(port, host=''):
+    server = WebServer(port, host=host)
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
     print(f"Listening on port {port}...")
+    server.serve_forever()
+
 
-    while True:
-        # Accepts a connection and handles the request
-        client_connection, client_address = server_socket.accept()
-        handle_request(client_connection)
-        client_connection.close()  # Closes the connection after handling the request
+def main():
+    parser = argparse.ArgumentParser(description="Serve the files of the current directory over HTTP")
+    parser.add_argument('--host', default='',
+                        help="address to listen on, e.g. 127.0.0.1 (default: every interface)")
+    parser.add_argument('--port', type=int, default=8080, help="port to listen on (default: 8080)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="server processes sharing the port, 0 for one per core (default: 1)")
+    parser.add_argument('--reuse-port', action='store_true',
+                        help="give every worker its own SO_REUSEPORT socket, balanced by the kernel")
+    args = parser.parse_args()
+    if args.reuse_port and not hasattr(socket, 'SO_REUSEPORT'):
+        parser.error("SO_REUSEPORT is not supported on this platform")
+    workers = args.workers or os.cpu_count()
+    if workers == 1 and not args.reuse_port:
+        start_server(args.port, args.host)
+    else:
+        run_workers(args.port, workers, args.reuse_port, args.host)
 
 
 if __name__ == "__main__":
-    start_server(8080)  # Start the server listening on port 8080
+    main()